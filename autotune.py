@@ -0,0 +1,240 @@
+'''
+CPU thread and batch-size autotuner.
+
+CPU throughput depends on torch.set_num_threads, the number of
+inter-op threads, the training batch size, and whether the MKL-DNN
+kernels are used for the nn.GRU layers. This command times short runs of
+train() and of GreedySearchDecoder with the model configuration over a
+grid of those settings. Each trial runs in a fresh process, because
+inter-op threads can only be set once per process. Batches are
+synthetic pairs with the corpus' length limits.
+
+Thread settings are tuned first at the configured batch size. Training
+batch sizes are then tried with the fastest training thread settings.
+The thread settings that train fastest (pairs/sec at the configured
+batch size) and serve fastest (latency of one greedy decode at
+--serve-batch-size) are saved under this host's name in the profile
+file (see hostprofile.py). chatbot.py applies the training settings at
+startup and retrieval.py the serving settings. The fastest batch size
+is only reported: it changes the optimization, so it is never applied
+automatically.
+
+    python autotune.py --threads 1 2 4 8 --batch-sizes 32 64 128
+'''
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch import optim
+
+from chatbot import (
+    MAX_LENGTH, PairArrays, GreedySearchDecoder, DEFAULT_CONFIG, buildModel,
+    train, padSegments, randomBatch, inference_mode, device,
+)
+from hostprofile import PROFILE_FILE, hostKey, mkldnnAvailable, applySettings, saveHostProfile
+from instrumentation import timeStage
+
+
+'''TRIALS'''
+
+
+def syntheticPairs(num_words, n_pairs, max_length=MAX_LENGTH, seed=0):
+    '''Random PairArrays with sentence lengths anywhere under max_length.'''
+    rng = np.random.RandomState(seed)
+    query_lengths = rng.randint(1, max_length, n_pairs)
+    response_lengths = rng.randint(1, max_length, n_pairs)
+    ids = rng.randint(3, num_words, int(query_lengths.sum() + response_lengths.sum()))
+    return PairArrays.fromSegments(ids, query_lengths, response_lengths)
+
+
+def runTrial(settings, model, steps, warmup, serve_batch_size):
+    '''
+    Times train() steps at settings["batch_size"] (if given) and greedy
+    decoding of serve_batch_size sentences under the given settings.
+    Meant to run in a fresh process.
+    '''
+    applySettings(settings)
+    random.seed(0)
+    torch.manual_seed(0)
+    embedding, encoder, decoder = buildModel(model["num_words"], model)
+    pairs = syntheticPairs(model["num_words"], 4096)
+    result = {}
+
+    batch_size = settings.get("batch_size")
+    if batch_size:
+        encoder.train()
+        decoder.train()
+        encoder_optimizer = optim.Adam(encoder.parameters(), lr=model["learning_rate"])
+        decoder_optimizer = optim.Adam(decoder.parameters(),
+                                       lr=model["learning_rate"] * model["decoder_learning_ratio"])
+
+        def step(batch):
+            input_variable, lengths, target_variable, mask, max_target_len = batch
+            train(input_variable, lengths, target_variable, mask, max_target_len, encoder, decoder,
+                  embedding, encoder_optimizer, decoder_optimizer, batch_size, model["clip"])
+        stats, _ = timeStage(step, steps, warmup, lambda: randomBatch(None, pairs, batch_size))
+        result["train_seconds_per_step"] = stats["median"]
+        result["train_pairs_per_sec"] = batch_size / stats["median"]
+
+    encoder.eval()
+    decoder.eval()
+    searcher = GreedySearchDecoder(encoder, decoder)
+
+    def setup():
+        indices = np.array([random.randrange(len(pairs)) for _ in range(serve_batch_size)])
+        indices = indices[np.argsort(-pairs.query_lengths[indices].astype(np.int64), kind="stable")]
+        input_batch, lengths = padSegments(pairs.ids, pairs.query_offsets[indices], pairs.query_lengths[indices])
+        return torch.from_numpy(input_batch).to(device), torch.from_numpy(lengths)
+
+    def decode(batch):
+        with inference_mode():
+            searcher(batch[0], batch[1], MAX_LENGTH)
+    stats, _ = timeStage(decode, steps * 4, warmup, setup)
+    result["serve_seconds"] = stats["median"]
+    return result
+
+
+def runIsolated(settings, model, args):
+    '''Runs one trial in a fresh spawned process; returns its result or error.'''
+    context = mp.get_context("spawn")
+    try:
+        with context.Pool(1) as pool:
+            result = pool.apply(runTrial, (settings, model, args.steps, args.warmup, args.serve_batch_size))
+    except Exception as e:
+        result = {"error": repr(e)}
+    return dict(settings, **result)
+
+
+'''SEARCH'''
+
+
+def defaultThreads():
+    cpus = os.cpu_count() or 1
+    candidates = {cpus}
+    n = 1
+    while n < cpus:
+        candidates.add(n)
+        n *= 2
+    return sorted(candidates)
+
+
+def printTrial(trial):
+    if "error" in trial:
+        print("  {} failed: {}".format(settingsOf(trial), trial["error"]))
+        return
+    throughput = ("{:>9.1f} pairs/s".format(trial["train_pairs_per_sec"])
+                  if "train_pairs_per_sec" in trial else " " * 16)
+    print("  {:<58} {}  {:>8.2f} ms/decode".format(str(settingsOf(trial)), throughput,
+                                                   trial["serve_seconds"] * 1000))
+
+
+SETTING_KEYS = ("threads", "interop_threads", "mkldnn", "batch_size")
+
+
+def settingsOf(trial, keys=SETTING_KEYS):
+    return {key: trial[key] for key in keys if key in trial}
+
+
+def autotune(model, args):
+    '''Runs both search stages and returns the host profile.'''
+    mkldnn = [True, False] if mkldnnAvailable() else [False]
+    trials = []
+    print("Tuning threads at batch size {}".format(model["batch_size"]))
+    for threads, interop_threads, use_mkldnn in itertools.product(args.threads, args.interop_threads, mkldnn):
+        settings = {"threads": threads, "interop_threads": interop_threads, "mkldnn": use_mkldnn,
+                    "batch_size": model["batch_size"]}
+        trials.append(runIsolated(settings, model, args))
+        printTrial(trials[-1])
+    measured = [t for t in trials if "error" not in t]
+    if not measured:
+        raise RuntimeError("every autotune trial failed")
+    best_train = max(measured, key=lambda t: t["train_pairs_per_sec"])
+    best_serve = min(measured, key=lambda t: t["serve_seconds"])
+
+    print("Tuning batch size with {}".format(settingsOf(best_train, SETTING_KEYS[:3])))
+    batch_trials = [best_train]
+    for batch_size in args.batch_sizes:
+        if batch_size == model["batch_size"]:
+            continue
+        settings = dict(settingsOf(best_train, SETTING_KEYS[:3]), batch_size=batch_size)
+        trials.append(runIsolated(settings, model, args))
+        printTrial(trials[-1])
+        if "error" not in trials[-1]:
+            batch_trials.append(trials[-1])
+    fastest_batch = max(batch_trials, key=lambda t: t["train_pairs_per_sec"])
+
+    return {
+        "train": settingsOf(best_train, SETTING_KEYS[:3]),
+        "serve": settingsOf(best_serve, SETTING_KEYS[:3]),
+        "train_pairs_per_sec": best_train["train_pairs_per_sec"],
+        # Reported only; batch size is a training hyperparameter, not a CPU setting
+        "batch_size_pairs_per_sec": {str(t["batch_size"]): t["train_pairs_per_sec"] for t in batch_trials},
+        "fastest_batch_size": fastest_batch["batch_size"],
+        "serve_seconds": best_serve["serve_seconds"],
+        "serve_batch_size": args.serve_batch_size,
+        "model": model,
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "trials": trials,
+    }
+
+
+'''COMMAND LINE'''
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, nargs="+", default=defaultThreads())
+    parser.add_argument("--interop-threads", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[32, 64, 128, 256])
+    parser.add_argument("--serve-batch-size", type=int, default=1,
+                        help="Sentences per greedy decode when tuning for serving")
+    parser.add_argument("--steps", type=int, default=5, help="Timed train steps per trial")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--num-words", type=int, default=None,
+                        help="Voc size (default: read from --checkpoint, else 8000)")
+    parser.add_argument("--checkpoint", default=None, help="trainIters checkpoint to take the Voc size from")
+    parser.add_argument("--attn-model", default=DEFAULT_CONFIG["attn_model"])
+    parser.add_argument("--hidden-size", type=int, default=DEFAULT_CONFIG["hidden_size"])
+    parser.add_argument("--encoder-n-layers", type=int, default=DEFAULT_CONFIG["encoder_n_layers"])
+    parser.add_argument("--decoder-n-layers", type=int, default=DEFAULT_CONFIG["decoder_n_layers"])
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_CONFIG["batch_size"],
+                        help="Training batch size used while tuning threads")
+    parser.add_argument("--profile", default=PROFILE_FILE)
+    args = parser.parse_args(argv)
+    model = {key: DEFAULT_CONFIG[key] for key in ("dropout", "clip", "learning_rate", "decoder_learning_ratio")}
+    model.update(attn_model=args.attn_model, hidden_size=args.hidden_size, batch_size=args.batch_size,
+                 encoder_n_layers=args.encoder_n_layers, decoder_n_layers=args.decoder_n_layers)
+    if args.num_words:
+        model["num_words"] = args.num_words
+    elif args.checkpoint:
+        checkpoint = torch.load(args.checkpoint, map_location="cpu")
+        model["num_words"] = checkpoint["voc_dict"]["num_words"]
+    else:
+        model["num_words"] = 8000
+    return args, model
+
+
+def main(argv=None):
+    args, model = parseArgs(argv)
+    profile = autotune(model, args)
+    saveHostProfile(profile, args.profile)
+    print("train: {}, {:.1f} pairs/s".format(profile["train"], profile["train_pairs_per_sec"]))
+    print("serve: {}, {:.2f} ms/decode".format(profile["serve"], profile["serve_seconds"] * 1000))
+    print("Fastest training batch size: {} (not applied; set batch_size in chatbot.py to use it)".format(
+        profile["fastest_batch_size"]))
+    print("Saved profile for {} to {}".format(hostKey(), args.profile))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,477 @@
+'''
+Benchmark harness for the chatbot pipeline.
+
+Each stage of preprocessing, training and decoding is timed separately
+on a generated corpus in the Cornell movie-lines format, so runs are
+reproducible without the real dataset. Results are written to a JSON
+file; pass --compare with an earlier results file to flag regressions.
+The baseline must have run on the same fixture, config, thread count
+and torch version.
+
+    python benchmark.py --fixture synthetic --output bench.json
+    python benchmark.py --fixture cornell --compare baseline.json
+'''
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+
+import torch
+from torch import optim
+
+from chatbot import (
+    MOVIE_LINES_FIELDS, MOVIE_CONVERSATIONS_FIELDS, MAX_LENGTH, MIN_COUNT,
+    Voc, loadLines, loadConversations, extractSentencePairs, normalizeString,
+    filterPairs, trimRareWords, batch2TrainData, inputVar, indexesFromSentence,
+    PairArrays, filterPairArrays, vocFromArrays, trimRareWordArrays, batch2TrainDataArrays,
+    DEFAULT_CONFIG, buildModel, GreedySearchDecoder, train, evaluateLoss, device,
+)
+from instrumentation import NULL_INSTRUMENTATION, TrainingInstrumentation, timeStage
+from retrieval import RetrievalIndex, buildIndex, encodeSentences
+
+
+# Fixture sizes, in conversations. "cornell" matches the real corpus:
+# 83,097 conversations and roughly 304,713 utterances.
+FIXTURES = {
+    "synthetic": 2000,
+    "cornell": 83097,
+}
+
+FIELD_SEPARATOR = " +++$+++ "
+
+
+'''FIXTURES'''
+
+
+def makeWordList(n_words, rng):
+    '''
+    Builds a list of pronounceable pseudo-words, with a few
+    contractions and accented words mixed in so that
+    normalizeString has something to do.
+    '''
+    consonants = "bcdfghjklmnprstvwz"
+    vowels = "aeiou"
+    words = ["i", "you", "the", "a", "don't", "it's", "what", "no", "yes", "café"]
+    seen = set(words)
+    while len(words) < n_words:
+        n_syllables = rng.randint(1, 3)
+        word = "".join(rng.choice(consonants) + rng.choice(vowels) for _ in range(n_syllables))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def writeSyntheticCorpus(directory, n_conversations, seed=0, n_words=20000):
+    '''
+    Writes movie_lines.txt and movie_conversations.txt in the
+    Cornell format. Words follow a Zipf-like distribution so that
+    trimRareWords drops a realistic share of the vocabulary.
+    '''
+    rng = random.Random(seed)
+    words = makeWordList(n_words, rng)
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(words))))
+    endings = [".", "?", "!", "...", ""]
+
+    lines_path = os.path.join(directory, "movie_lines.txt")
+    conversations_path = os.path.join(directory, "movie_conversations.txt")
+    line_id = 0
+    with open(lines_path, "w", encoding="iso-8859-1") as lines_file, \
+            open(conversations_path, "w", encoding="iso-8859-1") as conversations_file:
+        for conversation in range(n_conversations):
+            movie = "m{}".format(conversation // 150)
+            characters = ["u{}".format(2 * conversation), "u{}".format(2 * conversation + 1)]
+            utterance_ids = []
+            for turn in range(rng.randint(2, 6)):
+                n_tokens = rng.randint(1, 15)
+                text = " ".join(rng.choices(words, cum_weights=cum_weights, k=n_tokens))
+                text = text.capitalize() + rng.choice(endings)
+                lid = "L{}".format(line_id)
+                line_id += 1
+                utterance_ids.append(lid)
+                character = characters[turn % 2]
+                lines_file.write(FIELD_SEPARATOR.join(
+                    [lid, character, movie, character.upper(), text]) + "\n")
+            conversations_file.write(FIELD_SEPARATOR.join(
+                characters + [movie, str(utterance_ids)]) + "\n")
+    return lines_path, conversations_path
+
+
+'''TIMING'''
+
+
+def report(results, name, stats, **extra):
+    stats.update(extra)
+    results[name] = stats
+    print("{:<28} median {:>10.4f}s  min {:>10.4f}s".format(name, stats["median"], stats["min"]))
+
+
+'''STAGES'''
+
+
+def buildVoc(pairs):
+    voc = Voc("benchmark")
+    for pair in pairs:
+        voc.addSentence(pair[0])
+        voc.addSentence(pair[1])
+    return voc
+
+
+def benchmarkPreprocessing(results, directory, repeats):
+    lines_path = os.path.join(directory, "movie_lines.txt")
+    conversations_path = os.path.join(directory, "movie_conversations.txt")
+
+    stats, lines = timeStage(lambda: loadLines(lines_path, MOVIE_LINES_FIELDS), repeats)
+    report(results, "loadLines", stats, items=len(lines))
+
+    stats, conversations = timeStage(
+        lambda: loadConversations(conversations_path, lines, MOVIE_CONVERSATIONS_FIELDS), repeats)
+    report(results, "loadConversations", stats, items=len(conversations))
+
+    stats, raw_pairs = timeStage(lambda: extractSentencePairs(conversations), repeats)
+    report(results, "extractSentencePairs", stats, items=len(raw_pairs))
+
+    stats, normalized = timeStage(
+        lambda: [[normalizeString(s) for s in pair] for pair in raw_pairs], repeats)
+    report(results, "normalizeString", stats, items=2 * len(raw_pairs))
+
+    stats, pairs = timeStage(lambda: filterPairs(normalized), repeats)
+    report(results, "filterPairs", stats, items=len(pairs))
+
+    stats, voc = timeStage(lambda: buildVoc(pairs), repeats)
+    report(results, "countWords", stats, items=voc.num_words)
+
+    # voc.trim only runs once per Voc, so every repeat gets a fresh one
+    stats, kept = timeStage(lambda args: (args[0], trimRareWords(args[0], args[1], MIN_COUNT)),
+                            repeats, setup=lambda: (buildVoc(pairs), pairs))
+    voc, pairs = kept
+    report(results, "trimRareWords", stats, items=len(pairs))
+    return voc, pairs, normalized
+
+
+def deepSizeOfPairs(pairs):
+    '''Bytes held by a list of [query, response] string lists.'''
+    size = sys.getsizeof(pairs)
+    for pair in pairs:
+        size += sys.getsizeof(pair) + sum(sys.getsizeof(s) for s in pair)
+    return size
+
+
+def benchmarkArrays(results, memory, normalized, pairs, batch_size, n_batches, repeats):
+    '''
+    The same preprocessing on PairArrays, plus the memory held by the
+    prepared dataset as string lists versus token-id arrays.
+    '''
+    def encode():
+        index2word = []
+        return PairArrays.fromPairs(normalized, {}, index2word), index2word
+
+    stats, (arrays, index2word) = timeStage(encode, repeats)
+    report(results, "PairArrays.fromPairs", stats, items=len(arrays))
+    memory["normalized"] = {"strings": deepSizeOfPairs(normalized), "arrays": arrays.nbytes}
+
+    stats, filtered = timeStage(lambda: filterPairArrays(arrays), repeats)
+    report(results, "filterPairArrays", stats, items=len(filtered))
+
+    stats, (voc, _) = timeStage(lambda: vocFromArrays("benchmark", filtered, index2word), repeats)
+    report(results, "vocFromArrays", stats, items=voc.num_words)
+
+    # As with trimRareWords, every repeat needs a fresh Voc
+    stats, (voc, trimmed) = timeStage(
+        lambda args: (args[0], trimRareWordArrays(args[0], args[1], MIN_COUNT)),
+        repeats, setup=lambda: vocFromArrays("benchmark", filtered, index2word))
+    report(results, "trimRareWordArrays", stats, items=len(trimmed))
+    memory["trimmed"] = {"strings": deepSizeOfPairs(pairs), "arrays": trimmed.nbytes}
+
+    rng = random.Random(0)
+    samples = [[rng.randrange(len(trimmed)) for _ in range(batch_size)] for _ in range(n_batches)]
+    stats, _ = timeStage(lambda: [batch2TrainDataArrays(trimmed, batch) for batch in samples], repeats)
+    for key in ("median", "min", "mean"):
+        stats[key] /= n_batches
+    report(results, "batch2TrainDataArrays", stats, batch_size=batch_size)
+
+    for name in ("normalized", "trimmed"):
+        sizes = memory[name]
+        sizes["ratio"] = sizes["strings"] / sizes["arrays"] if sizes["arrays"] else None
+        print("{:<28} strings {:>8.1f}MB  arrays {:>8.1f}MB  x{:.1f}".format(
+            "pairs memory[{}]".format(name), sizes["strings"] / 2**20, sizes["arrays"] / 2**20,
+            sizes["ratio"] or 0))
+    return voc, trimmed
+
+
+def checkArrays(voc, pairs, array_voc, arrays, batch_size, n_batches):
+    '''
+    Checks that the PairArrays pipeline (vocFromArrays,
+    trimRareWordArrays, batch2TrainDataArrays) gives the same Voc,
+    the same kept pairs and the same batch tensors as the string
+    pipeline. Raises RuntimeError on the first difference.
+    '''
+    for field in ("num_words", "word2index", "word2count", "index2word"):
+        if getattr(voc, field) != getattr(array_voc, field):
+            raise RuntimeError("array pipeline gives a different Voc.{}".format(field))
+    if arrays.toPairs(array_voc) != pairs:
+        raise RuntimeError("array pipeline keeps different pairs")
+    rng = random.Random(4)
+    names = ("input_variable", "lengths", "target_variable", "mask", "max_target_len")
+    for _ in range(n_batches):
+        indices = [rng.randrange(len(pairs)) for _ in range(batch_size)]
+        expected = batch2TrainData(voc, [pairs[i] for i in indices])
+        actual = batch2TrainDataArrays(arrays, indices)
+        for name, a, b in zip(names, expected, actual):
+            same = torch.equal(a, b) if isinstance(a, torch.Tensor) else a == b
+            if not same:
+                raise RuntimeError("batch2TrainDataArrays gives a different {}".format(name))
+    print("Array pipeline matches the string pipeline ({} pairs, {} batches)".format(len(pairs), n_batches))
+
+
+def benchmarkBatching(results, voc, pairs, batch_size, n_batches, repeats):
+    rng = random.Random(0)
+    samples = [[rng.choice(pairs) for _ in range(batch_size)] for _ in range(n_batches)]
+    stats, _ = timeStage(lambda: [batch2TrainData(voc, list(batch)) for batch in samples], repeats)
+    for key in ("median", "min", "mean"):
+        stats[key] /= n_batches
+    report(results, "batch2TrainData", stats, batch_size=batch_size)
+
+
+def modelConfig(args):
+    '''DEFAULT_CONFIG with the model flags applied.'''
+    return dict(DEFAULT_CONFIG, hidden_size=args.hidden_size, encoder_n_layers=args.layers,
+                decoder_n_layers=args.layers, attn_model=args.attn_model, dropout=args.dropout)
+
+
+def benchmarkTraining(results, voc, pairs, args):
+    config = modelConfig(args)
+    embedding, encoder, decoder = buildModel(voc.num_words, config)
+    encoder.train()
+    decoder.train()
+    encoder_optimizer = optim.Adam(encoder.parameters(), lr=config["learning_rate"])
+    decoder_optimizer = optim.Adam(decoder.parameters(),
+                                   lr=config["learning_rate"] * config["decoder_learning_ratio"])
+    rng = random.Random(1)
+
+    def setup():
+        return batch2TrainData(voc, [rng.choice(pairs) for _ in range(args.batch_size)])
+
+    def makeStep(instrumentation):
+        def step(batch):
+            input_variable, lengths, target_variable, mask, max_target_len = batch
+            return train(input_variable, lengths, target_variable, mask, max_target_len,
+                         encoder, decoder, embedding, encoder_optimizer, decoder_optimizer,
+                         args.batch_size, config["clip"], instrumentation=instrumentation)
+        return step
+
+    stats, _ = timeStage(makeStep(NULL_INSTRUMENTATION), args.train_repeats, warmup=1, setup=setup)
+    report(results, "train", stats, batch_size=args.batch_size)
+
+    # Same step with every hook active, to keep an eye on instrumentation overhead
+    instrumentation = TrainingInstrumentation(os.devnull, interval=args.train_repeats + 1)
+    stats, _ = timeStage(makeStep(instrumentation), args.train_repeats, warmup=1, setup=setup)
+    instrumentation.close()
+    report(results, "train[instrumented]", stats, batch_size=args.batch_size)
+
+    # One validation pass, as scheduled from trainIters
+    valid_pairs = pairs[:args.valid_pairs]
+    stats, metrics = timeStage(lambda: evaluateLoss(encoder, decoder, voc, valid_pairs, args.valid_batch_size),
+                               args.repeats, warmup=1)
+    report(results, "evaluateLoss", stats, pairs=len(valid_pairs), batch_size=args.valid_batch_size,
+           seconds_per_train_step=results["train"]["median"])
+    return encoder, decoder
+
+
+def benchmarkDecoding(results, voc, pairs, encoder, decoder, batch_sizes, repeats):
+    encoder.eval()
+    decoder.eval()
+    searcher = GreedySearchDecoder(encoder, decoder)
+    rng = random.Random(2)
+    for batch_size in batch_sizes:
+        sentences = [rng.choice(pairs)[0] for _ in range(batch_size)]
+        sentences.sort(key=lambda s: len(indexesFromSentence(voc, s)), reverse=True)
+        input_batch, lengths = inputVar(sentences, voc)
+        input_batch = input_batch.to(device)
+
+        def decode():
+            with torch.no_grad():
+                return searcher(input_batch, lengths, MAX_LENGTH)
+
+        stats, _ = timeStage(decode, repeats, warmup=1)
+        report(results, "greedyDecode[bs={}]".format(batch_size), stats, batch_size=batch_size)
+
+
+def benchmarkRetrieval(results, memory, voc, pairs, encoder, args):
+    '''
+    Index build time, batched query latency (encoding included) for
+    exact and partitioned search, and the bytes the index holds.
+    '''
+    encoder.eval()
+    arrays = PairArrays.fromPairs(pairs, dict(voc.word2index))
+    index_dir = tempfile.mkdtemp(prefix="chatbot-index-")
+    try:
+        stats, _ = timeStage(lambda: buildIndex(encoder, voc, arrays, index_dir, n_lists=args.n_lists), 1)
+        report(results, "buildIndex[n_lists={}]".format(args.n_lists), stats, items=len(arrays))
+        index = RetrievalIndex(index_dir)
+        memory["retrieval_index"] = {"arrays": index.nbytes}
+
+        rng = random.Random(3)
+        sentences = [rng.choice(pairs)[0] for _ in range(args.retrieval_batch_size)]
+        for nprobe in (None, args.nprobe):
+            stats, _ = timeStage(
+                lambda: index.search(encodeSentences(encoder, voc, sentences), k=5, nprobe=nprobe),
+                args.repeats, warmup=1)
+            report(results, "retrieve[bs={},nprobe={}]".format(len(sentences), nprobe or "exact"), stats,
+                   batch_size=len(sentences))
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+
+'''COMPARISON'''
+
+
+# Run conditions that must match for timings to be comparable
+COMPARABLE_META = ("fixture", "config", "threads", "torch")
+# Flags that do not change what is timed
+IGNORED_CONFIG = ("tolerance", "allow_mismatch")
+
+
+def metaMismatches(current, baseline):
+    '''Returns (key, baseline, current) for every run condition that differs.'''
+    mismatches = []
+    for key in COMPARABLE_META:
+        before = baseline.get("meta", {}).get(key)
+        after = current["meta"].get(key)
+        if key == "config" and before is not None:
+            before = {k: v for k, v in before.items() if k not in IGNORED_CONFIG}
+            after = {k: v for k, v in after.items() if k not in IGNORED_CONFIG}
+            mismatches.extend(("config." + k, before.get(k), after.get(k))
+                              for k in sorted(set(before) | set(after)) if before.get(k) != after.get(k))
+        elif before != after:
+            mismatches.append((key, before, after))
+    return mismatches
+
+
+def compareResults(current, baseline, tolerance):
+    '''
+    Returns a list of (stage, baseline, current, ratio) for every stage
+    whose median got slower than the baseline by more than `tolerance`.
+    '''
+    regressions = []
+    for name, stats in current["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        before = baseline["stages"][name]["median"]
+        after = stats["median"]
+        ratio = after / before if before > 0 else float("inf")
+        flag = "REGRESSION" if ratio > 1 + tolerance else ""
+        print("{:<28} {:>10.4f}s -> {:>10.4f}s  x{:.2f} {}".format(name, before, after, ratio, flag))
+        if flag:
+            regressions.append((name, before, after, ratio))
+    return regressions
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixture", choices=sorted(FIXTURES), default="synthetic")
+    parser.add_argument("--corpus", default=None,
+                        help="Directory with real movie_lines.txt/movie_conversations.txt; "
+                             "overrides --fixture")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="Baseline results file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slowdown before a stage is flagged (0.2 = 20%%)")
+    parser.add_argument("--allow-mismatch", action="store_true",
+                        help="Compare even if the baseline ran on another fixture, config, "
+                             "thread count or torch version")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--train-repeats", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_CONFIG["batch_size"])
+    parser.add_argument("--n-batches", type=int, default=100)
+    parser.add_argument("--valid-pairs", type=int, default=2048)
+    parser.add_argument("--valid-batch-size", type=int, default=1024)
+    parser.add_argument("--decode-batch-sizes", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--retrieval-batch-size", type=int, default=64)
+    parser.add_argument("--n-lists", type=int, default=64)
+    parser.add_argument("--nprobe", type=int, default=4)
+    parser.add_argument("--hidden-size", type=int, default=DEFAULT_CONFIG["hidden_size"])
+    parser.add_argument("--layers", type=int, default=DEFAULT_CONFIG["encoder_n_layers"],
+                        help="Encoder and decoder layers")
+    parser.add_argument("--attn-model", default=DEFAULT_CONFIG["attn_model"])
+    parser.add_argument("--dropout", type=float, default=DEFAULT_CONFIG["dropout"])
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    stages = {}
+    memory = {}
+    directory = args.corpus
+    tmpdir = None
+    try:
+        if directory is None:
+            tmpdir = tempfile.mkdtemp(prefix="chatbot-bench-")
+            directory = tmpdir
+            print("Writing {} fixture ({} conversations)...".format(args.fixture, FIXTURES[args.fixture]))
+            writeSyntheticCorpus(directory, FIXTURES[args.fixture], seed=args.seed)
+
+        voc, pairs, normalized = benchmarkPreprocessing(stages, directory, args.repeats)
+        benchmarkBatching(stages, voc, pairs, args.batch_size, args.n_batches, args.repeats)
+        array_voc, arrays = benchmarkArrays(stages, memory, normalized, pairs, args.batch_size,
+                                            args.n_batches, args.repeats)
+        checkArrays(voc, pairs, array_voc, arrays, args.batch_size, args.n_batches)
+        del array_voc, arrays
+        del normalized
+        encoder, decoder = benchmarkTraining(stages, voc, pairs, args)
+        benchmarkDecoding(stages, voc, pairs, encoder, decoder, args.decode_batch_sizes, args.repeats)
+        benchmarkRetrieval(stages, memory, voc, pairs, encoder, args)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    results = {
+        "meta": {
+            "fixture": "corpus" if args.corpus else args.fixture,
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "machine": platform.machine(),
+            "threads": torch.get_num_threads(),
+            "device": str(device),
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "stages": stages,
+        "memory_bytes": memory,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Wrote", args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print("\nComparing against", args.compare)
+        mismatches = metaMismatches(results, baseline)
+        for key, before, after in mismatches:
+            print("WARNING: {} differs: baseline {!r}, this run {!r}".format(key, before, after))
+        if mismatches and not args.allow_mismatch:
+            print("Refusing to compare runs made under different conditions (pass --allow-mismatch to override)")
+            return 2
+        regressions = compareResults(results, baseline, args.tolerance)
+        if regressions:
+            print("{} stage(s) regressed by more than {:.0%}".format(len(regressions), args.tolerance))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
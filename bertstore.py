@@ -0,0 +1,308 @@
+'''
+Precomputed BERT features for the pretrained-encoder mode.
+
+With `feature_size` set, EncoderRNN projects contextual features
+instead of looking up its own word embeddings. Running BERT on every
+training step is too slow on CPU, so the features are computed once,
+in batches, for every unique query and written to a memory-mapped
+store:
+
+    features.npy        (total BERT tokens, hidden) float16, one row per word piece
+    feature_offsets.npy, feature_lengths.npy   rows of each unique query
+    query_ids.npy, query_offsets.npy, query_lengths.npy
+                        the voc ids of each unique query, to look pairs up
+    meta.json
+
+FeaturePairs wraps PairArrays so that trainIters, splitPairs and
+evaluateLoss batch straight from the store; each batch only reads the
+rows it needs from the mapped file.
+
+    python bertstore.py build --out data/bert_features
+    python bertstore.py compare data/bert_features --batches 20
+'''
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+from torch import optim
+from transformers import BertModel, BertTokenizer
+
+from chatbot import (
+    DEFAULT_CONFIG, datafile, outputVarArrays, loadTrimmedArrays, buildModel, train, device,
+)
+
+
+BERT_MODEL = 'bert-base-uncased'
+META_FILE = "meta.json"
+
+
+def loadBert(model_name=BERT_MODEL):
+    tokenizer = BertTokenizer.from_pretrained(model_name)
+    model = BertModel.from_pretrained(model_name).to(device)
+    model.eval()
+    return tokenizer, model
+
+
+def queryKey(ids):
+    return np.asarray(ids, dtype=np.int64).tobytes()
+
+
+def queryText(voc, ids):
+    return " ".join(voc.index2word[int(t)] for t in ids)
+
+
+def tokenize(tokenizer, texts):
+    '''BERT token ids of each text, with [CLS] and [SEP].'''
+    return [tokenizer.encode(text, add_special_tokens=True) for text in texts]
+
+
+def bertFeatures(tokenizer, model, token_ids):
+    '''
+    Runs BERT over a batch of tokenized texts (see tokenize). Returns
+    the last hidden states as a (batch_size, max_tokens, hidden) array
+    and each text's token count.
+    '''
+    lengths = np.array([len(ids) for ids in token_ids], dtype=np.int64)
+    max_tokens = int(lengths.max())
+    input_ids = torch.full((len(token_ids), max_tokens), tokenizer.pad_token_id, dtype=torch.long)
+    for i, ids in enumerate(token_ids):
+        input_ids[i, :len(ids)] = torch.tensor(ids)
+    attention_mask = (torch.arange(max_tokens).unsqueeze(0) < torch.from_numpy(lengths).unsqueeze(1)).long()
+    with torch.no_grad():
+        # Models outputs are tuples
+        hidden = model(input_ids.to(device), attention_mask=attention_mask.to(device))[0]
+    return hidden.cpu().numpy(), lengths
+
+
+'''BUILD'''
+
+
+def buildFeatureStore(directory, voc, pairs, tokenizer, model, batch_size=256, dtype=np.float16,
+                      model_name=BERT_MODEL):
+    '''
+    Computes BERT features for every unique query in pairs (PairArrays)
+    and writes the store to directory. Returns the time it took.
+    '''
+    start = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+    # Unique queries, in order of first appearance
+    seen = set()
+    unique = []
+    for i in range(len(pairs)):
+        key = queryKey(pairs.query(i))
+        if key not in seen:
+            seen.add(key)
+            unique.append(i)
+    queries = pairs.subset(unique)
+    texts = [queryText(voc, queries.query(i)) for i in range(len(queries))]
+
+    # Tokenize once up front, so the feature matrix can be allocated at its final size
+    token_ids = tokenize(tokenizer, texts)
+    lengths = np.array([len(ids) for ids in token_ids], dtype=np.int64)
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    hidden_size = model.config.hidden_size
+    features = np.lib.format.open_memmap(os.path.join(directory, "features.npy"), mode="w+",
+                                         dtype=dtype, shape=(int(lengths.sum()), hidden_size))
+
+    # Longest first, so batches hold texts of similar length
+    order = np.argsort(-lengths, kind="stable")
+    for first in range(0, len(order), batch_size):
+        rows = order[first:first + batch_size]
+        hidden, batch_lengths = bertFeatures(tokenizer, model, [token_ids[row] for row in rows])
+        for j, row in enumerate(rows):
+            features[offsets[row]:offsets[row] + batch_lengths[j]] = hidden[j, :batch_lengths[j]]
+        print("Encoded {}/{} unique queries".format(min(first + batch_size, len(order)), len(order)))
+    features.flush()
+
+    # The voc ids of each unique query, so pairs can be matched to their rows
+    query_lengths = queries.query_lengths.astype(np.int64)
+    query_offsets = np.zeros(len(query_lengths), dtype=np.int64)
+    np.cumsum(query_lengths[:-1], out=query_offsets[1:])
+    query_ids = np.zeros(int(query_lengths.sum()), dtype=np.int64)
+    for i in range(len(queries)):
+        query_ids[query_offsets[i]:query_offsets[i] + query_lengths[i]] = queries.query(i)
+    np.save(os.path.join(directory, "feature_offsets.npy"), offsets)
+    np.save(os.path.join(directory, "feature_lengths.npy"), lengths)
+    np.save(os.path.join(directory, "query_ids.npy"), query_ids)
+    np.save(os.path.join(directory, "query_offsets.npy"), query_offsets)
+    np.save(os.path.join(directory, "query_lengths.npy"), query_lengths)
+    seconds = time.perf_counter() - start
+    with open(os.path.join(directory, META_FILE), "w") as f:
+        json.dump({"model": model_name,
+                   "hidden_size": hidden_size, "queries": len(queries),
+                   "tokens": int(lengths.sum()), "dtype": np.dtype(dtype).name,
+                   "build_seconds": seconds}, f)
+    return seconds
+
+
+'''READ'''
+
+
+class BertFeatureStore:
+    def __init__(self, directory):
+        with open(os.path.join(directory, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.feature_size = self.meta["hidden_size"]
+        # Memory-mapped: only the rows a batch touches are read from disk
+        self.features = np.load(os.path.join(directory, "features.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, "feature_offsets.npy"))
+        self.lengths = np.load(os.path.join(directory, "feature_lengths.npy"))
+        query_ids = np.load(os.path.join(directory, "query_ids.npy"))
+        query_offsets = np.load(os.path.join(directory, "query_offsets.npy"))
+        query_lengths = np.load(os.path.join(directory, "query_lengths.npy"))
+        self.rows = {queryKey(query_ids[start:start + length]): row
+                     for row, (start, length) in enumerate(zip(query_offsets, query_lengths))}
+
+    def rowsFor(self, arrays):
+        '''Store row of every query in arrays; KeyError if one was not stored.'''
+        return np.array([self.rows[queryKey(arrays.query(i))] for i in range(len(arrays))],
+                        dtype=np.int64)
+
+    def gather(self, rows):
+        '''
+        Zero-padded (max_tokens, batch_size, feature_size) float32 tensor
+        for the given rows, and their lengths.
+        '''
+        lengths = self.lengths[rows]
+        batch = np.zeros((lengths.max(), len(rows), self.feature_size), dtype=np.float32)
+        for j, row in enumerate(rows):
+            start = self.offsets[row]
+            batch[:lengths[j], j] = self.features[start:start + lengths[j]]
+        return torch.from_numpy(batch), torch.from_numpy(lengths)
+
+
+class FeaturePairs:
+    '''
+    PairArrays whose queries are read as BERT features from a store.
+    A dataset in the sense of chatbot.randomBatch.
+    '''
+    def __init__(self, store, arrays, rows=None):
+        self.store = store
+        self.arrays = arrays
+        self.rows = store.rowsFor(arrays) if rows is None else rows
+        self.query_lengths = store.lengths[self.rows]
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def subset(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        return FeaturePairs(self.store, self.arrays.subset(indices), self.rows[indices])
+
+    def batch(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        # Sort by feature length, longest first, for pack_padded_sequence
+        indices = indices[np.argsort(-self.query_lengths[indices], kind="stable")]
+        return self.store.gather(self.rows[indices]) + outputVarArrays(self.arrays, indices)
+
+
+class LiveFeaturePairs:
+    '''Like FeaturePairs, but runs BERT for every batch; the baseline the store replaces.'''
+    def __init__(self, voc, arrays, tokenizer, model):
+        self.voc = voc
+        self.arrays = arrays
+        self.tokenizer = tokenizer
+        self.model = model
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def batch(self, indices):
+        texts = [queryText(self.voc, self.arrays.query(i)) for i in indices]
+        hidden, lengths = bertFeatures(self.tokenizer, self.model, tokenize(self.tokenizer, texts))
+        order = np.argsort(-lengths, kind="stable")
+        inp = torch.from_numpy(np.ascontiguousarray(hidden[order].transpose(1, 0, 2), dtype=np.float32))
+        return ((inp, torch.from_numpy(lengths[order]))
+                + outputVarArrays(self.arrays, np.asarray(indices, dtype=np.int64)[order]))
+
+
+'''COMPARE'''
+
+
+def compareEpochTime(voc, store_pairs, live_pairs, n_batches=20, batch_size=64, config=DEFAULT_CONFIG):
+    '''
+    Times n_batches of batch construction plus a train step reading
+    features from the store, then computing them live with BERT, and
+    extrapolates both to one epoch over the pairs. The model is built
+    from config.
+    '''
+    batches_per_epoch = math.ceil(len(store_pairs) / batch_size)
+    results = {}
+    for name, pairs in (("store", store_pairs), ("live", live_pairs)):
+        random.seed(0)
+        torch.manual_seed(0)
+        embedding, encoder, decoder = buildModel(voc.num_words, config, feature_size=store_pairs.store.feature_size)
+        encoder_optimizer = optim.Adam(encoder.parameters(), lr=config["learning_rate"])
+        decoder_optimizer = optim.Adam(decoder.parameters(),
+                                       lr=config["learning_rate"] * config["decoder_learning_ratio"])
+        samples = [[random.randrange(len(pairs)) for _ in range(batch_size)] for _ in range(n_batches)]
+        batch_seconds = 0.0
+        start = time.perf_counter()
+        for indices in samples:
+            batch_start = time.perf_counter()
+            input_variable, lengths, target_variable, mask, max_target_len = pairs.batch(indices)
+            batch_seconds += time.perf_counter() - batch_start
+            train(input_variable, lengths, target_variable, mask, max_target_len, encoder, decoder,
+                  embedding, encoder_optimizer, decoder_optimizer, batch_size, config["clip"])
+        seconds = time.perf_counter() - start
+        results[name] = {
+            "seconds_per_batch": seconds / n_batches,
+            "feature_seconds_per_batch": batch_seconds / n_batches,
+            "seconds_per_epoch": seconds / n_batches * batches_per_epoch,
+        }
+        print("{:<6} {:.3f}s/batch ({:.3f}s reading features), {:.1f}s/epoch".format(
+            name, results[name]["seconds_per_batch"], results[name]["feature_seconds_per_batch"],
+            results[name]["seconds_per_epoch"]))
+    results["speedup"] = results["live"]["seconds_per_epoch"] / results["store"]["seconds_per_epoch"]
+    print("Store is {:.1f}x faster per epoch".format(results["speedup"]))
+    return results
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    build = commands.add_parser("build", help="Compute the store for every unique query")
+    build.add_argument("--out", required=True)
+    build.add_argument("--datafile", default=datafile)
+    build.add_argument("--model", default=BERT_MODEL)
+    build.add_argument("--batch-size", type=int, default=256)
+    compare = commands.add_parser("compare", help="Epoch time with the store versus live BERT")
+    compare.add_argument("store")
+    compare.add_argument("--datafile", default=datafile)
+    compare.add_argument("--model", default=BERT_MODEL)
+    compare.add_argument("--batches", type=int, default=20)
+    compare.add_argument("--batch-size", type=int, default=64)
+    compare.add_argument("--output", default=None, help="Write the comparison as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    voc, pairs = loadTrimmedArrays(args.datafile)
+    tokenizer, model = loadBert(args.model)
+    if args.command == "build":
+        seconds = buildFeatureStore(args.out, voc, pairs, tokenizer, model, args.batch_size,
+                                    model_name=args.model)
+        print("Wrote {} in {:.1f}s".format(args.out, seconds))
+    else:
+        store_pairs = FeaturePairs(BertFeatureStore(args.store), pairs)
+        live_pairs = LiveFeaturePairs(voc, pairs, tokenizer, model)
+        results = compareEpochTime(voc, store_pairs, live_pairs, args.batches, args.batch_size)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,7 +8,6 @@ from torch.jit import script, trace
 import torch.nn as nn
 from torch import optim
 import torch.nn.functional as F
-from transformers import BertModel, BertTokenizer
 import csv
 import random
 import re
@@ -18,17 +17,12 @@ import codecs
 from io import open
 import itertools
 import math
+import time
+import numpy as np
 
+from instrumentation import NULL_INSTRUMENTATION, TrainingInstrumentation
+from hostprofile import applyHostProfile
 
-# BERT = BertModel, BertTokenizer, 'bert-base-uncased'
-#BERT_MODEL_CLASSES = [BertModel, BertForPreTraining, BertForMaskedLM, BertForNextSentencePrediction,
-#                      BertForSequenceClassification, BertForTokenClassification, BertForQuestionAnswering]
-tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-model = BertModel.from_pretrained('bert-base-uncased')
-
-input_ids = torch.tensor([tokenizer.encode("", add_special_tokens=True)])
-with torch.no_grad():
-    last_hidden_states = model(input_ids)[0] # Models outputs are now tuples
 
 USE_CUDA = torch.cuda.is_available()
 device = torch.device("cuda" if USE_CUDA else "cpu")
@@ -136,30 +130,30 @@ delimiter = "\t"
 # Unescape the delimiter
 delimiter = str(codecs.decode(delimiter, "unicode_escape"))
 
-# Initialize lines dict, conversations list, and field ids
-lines = {}
-conversations = []
+# Field ids
 MOVIE_LINES_FIELDS = ["lineID", "characterID", "movieID", "character", "text"]
 MOVIE_CONVERSATIONS_FIELDS = ["character1ID", "character2ID", "movieID", "utteranceIDs"]
 
-# Load lines and process conversations
-print("\nProcessing corpus...")
-lines = loadLines(os.path.join(corpus, "movie_lines.txt"), MOVIE_LINES_FIELDS)
-print("\nLoading conversations...")
-conversations = loadConversations(
-    os.path.join(corpus, "movie_conversations.txt"), lines, MOVIE_CONVERSATIONS_FIELDS
-)
-
-# Write new csv file
-print("\nWriting newly formatted file...")
-with open(datafile, "w", encoding="utf-8") as outputfile:
-    writer = csv.writer(outputfile, delimiter=delimiter, lineterminator="\n")
-    for pair in extractSentencePairs(conversations):
-        writer.writerow(pair)
-
-# Print a sample of lines
-# print("\nSample lines from file:")
-# heprintlines(datafile)
+
+def writeFormattedFile(corpus, datafile):
+    """
+    writeFormattedFile loads the corpus lines and conversations
+    and writes their sentence pairs to datafile
+    """
+    # Load lines and process conversations
+    print("\nProcessing corpus...")
+    lines = loadLines(os.path.join(corpus, "movie_lines.txt"), MOVIE_LINES_FIELDS)
+    print("\nLoading conversations...")
+    conversations = loadConversations(
+        os.path.join(corpus, "movie_conversations.txt"), lines, MOVIE_CONVERSATIONS_FIELDS
+    )
+
+    # Write new csv file
+    print("\nWriting newly formatted file...")
+    with open(datafile, "w", encoding="utf-8") as outputfile:
+        writer = csv.writer(outputfile, delimiter=delimiter, lineterminator="\n")
+        for pair in extractSentencePairs(conversations):
+            writer.writerow(pair)
 
 """LOAD AND TRIM DATA"""
 
@@ -284,14 +278,7 @@ def loadPrepareData(corpus, corpus_name, datafile, save_dir):
     return voc, pairs
 
 
-# Load/Assemble voc and pairs
-print("Assembling pairs...")
 save_dir = os.path.join("data", "save")
-voc, pairs = loadPrepareData(corpus, corpus_name, datafile, save_dir)
-# Print some pairs to validate
-# print("\npairs:")
-# for pair in pairs[:10]:
-#     print(pair)
 
 """
 Achieving faster convergence during training 
@@ -337,9 +324,6 @@ def trimRareWords(voc, pairs, MIN_COUNT):
     return keep_pairs
 
 
-# Trim voc and pairs
-pairs = trimRareWords(voc, pairs, MIN_COUNT)
-
 '''PREPARE DATA FOR MODELS'''
 
 '''
@@ -437,16 +421,276 @@ def batch2TrainData(voc, pair_batch):
     return inp, lengths, output, mask, max_target_len
 
 
-# Example for validation
-small_batch_size = 5
-batches = batch2TrainData(voc, [random.choice(pairs) for _ in range(small_batch_size)])
-input_variable, lengths, target_variable, mask, max_target_len = batches
+'''TOKEN ARRAYS'''
+
+'''
+The string pairs above are re-split by every consumer. PairArrays
+holds the prepared dataset as flat integer arrays instead: `ids` is
+every token id of every pair concatenated (query then response, pair
+after pair, without EOS). Each query is addressed by an offset into
+`ids` and a length; its response starts right after it, so only the
+response length is stored. Filtering, trimming and batching then run
+as NumPy operations over those arrays.
+'''
+
+
+def smallestIntType(max_value):
+    '''Smallest unsigned NumPy dtype that can hold max_value.'''
+    return np.min_scalar_type(max(int(max_value), 0))
+
+
+class PairArrays:
+    def __init__(self, ids, query_offsets, query_lengths, response_lengths):
+        self.ids = ids
+        self.query_offsets = query_offsets
+        self.query_lengths = query_lengths
+        self.response_lengths = response_lengths
+
+    @classmethod
+    def fromSegments(cls, ids, query_lengths, response_lengths):
+        '''
+        Builds PairArrays from interleaved ids (q0 r0 q1 r1 ...) and
+        per-pair lengths, picking the smallest dtypes that fit.
+        '''
+        query_lengths = np.asarray(query_lengths, dtype=np.int64)
+        response_lengths = np.asarray(response_lengths, dtype=np.int64)
+        ids = np.asarray(ids)
+        pair_lengths = query_lengths + response_lengths
+        query_offsets = np.zeros(len(pair_lengths), dtype=np.int64)
+        np.cumsum(pair_lengths[:-1], out=query_offsets[1:])
+        offset_type = smallestIntType(len(ids))
+        length_type = smallestIntType(max(query_lengths.max(initial=0), response_lengths.max(initial=0)))
+        return cls(ids.astype(smallestIntType(ids.max(initial=0)), copy=False),
+                   query_offsets.astype(offset_type), query_lengths.astype(length_type),
+                   response_lengths.astype(length_type))
+
+    @classmethod
+    def fromPairs(cls, pairs, word2index, index2word=None):
+        '''
+        Encodes string pairs with word2index. If index2word is given it
+        must list the words of word2index by id; missing words are then
+        numbered from len(index2word) and added to both. Without it a
+        missing word raises KeyError, as in indexesFromSentence.
+        '''
+        ids = []
+        query_lengths = []
+        response_lengths = []
+        for query, response in pairs:
+            for sentence, sentence_lengths in ((query, query_lengths), (response, response_lengths)):
+                words = sentence.split(" ")
+                for word in words:
+                    index = word2index.get(word)
+                    if index is None:
+                        if index2word is None:
+                            raise KeyError(word)
+                        index = word2index[word] = len(index2word)
+                        index2word.append(word)
+                    ids.append(index)
+                sentence_lengths.append(len(words))
+        return cls.fromSegments(np.array(ids, dtype=np.int64), query_lengths, response_lengths)
+
+    def __len__(self):
+        return len(self.query_lengths)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.ids, self.query_offsets, self.query_lengths,
+                                      self.response_lengths))
+
+    def responseOffsets(self, indices=slice(None)):
+        '''Offsets into ids of the given pairs' responses (all by default).'''
+        return self.query_offsets[indices].astype(np.int64) + self.query_lengths[indices]
+
+    def query(self, i):
+        start = self.query_offsets[i]
+        return self.ids[start:start + self.query_lengths[i]]
+
+    def response(self, i):
+        start = int(self.query_offsets[i]) + int(self.query_lengths[i])
+        return self.ids[start:start + self.response_lengths[i]]
+
+    def toPairs(self, voc):
+        '''Decodes back to a list of [query, response] strings.'''
+        return [[" ".join(voc.index2word[int(t)] for t in self.query(i)),
+                 " ".join(voc.index2word[int(t)] for t in self.response(i))]
+                for i in range(len(self))]
+
+    def subset(self, indices):
+        '''Returns a compacted PairArrays holding only the given pairs, in order.'''
+        indices = np.asarray(indices, dtype=np.int64)
+        query_lengths = self.query_lengths[indices].astype(np.int64)
+        response_lengths = self.response_lengths[indices].astype(np.int64)
+        # A pair's query and response are one contiguous segment of ids
+        starts = self.query_offsets[indices]
+        lengths = query_lengths + response_lengths
+        ends = np.cumsum(lengths)
+        shifts = np.repeat(starts.astype(np.int64) - (ends - lengths), lengths)
+        positions = np.arange(ends[-1] if len(ends) else 0) + shifts
+        return PairArrays.fromSegments(self.ids[positions], query_lengths, response_lengths)
+
+    def batch(self, indices):
+        return batch2TrainDataArrays(self, indices)
+
+    def segmentSums(self, values):
+        '''
+        Sums `values` (one per token in ids) over each query and each
+        response; returns (query_sums, response_sums).
+        '''
+        totals = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(values, out=totals[1:])
+        query_starts = self.query_offsets.astype(np.int64)
+        response_starts = self.responseOffsets()
+        return (totals[query_starts + self.query_lengths] - totals[query_starts],
+                totals[response_starts + self.response_lengths] - totals[response_starts])
+
+
+def filterPairArrays(arrays, max_length=MAX_LENGTH):
+    '''Vectorized filterPairs: keeps pairs whose sides are both under max_length words.'''
+    keep = (arrays.query_lengths < max_length) & (arrays.response_lengths < max_length)
+    return arrays.subset(np.flatnonzero(keep))
+
+
+def vocFromArrays(name, arrays, index2word):
+    '''
+    Builds a Voc from provisional ids (indexing into index2word) and
+    returns it with arrays re-encoded in its ids. Words are numbered in
+    order of first appearance and counted, exactly as calling
+    voc.addSentence on every query and response would.
+    '''
+    voc = Voc(name)
+    provisional, first_seen, counts = np.unique(arrays.ids, return_index=True, return_counts=True)
+    order = np.argsort(first_seen, kind="stable")
+    remap = np.zeros(len(index2word), dtype=np.int64)
+    remap[provisional[order]] = np.arange(voc.num_words, voc.num_words + len(order))
+    for i in order:
+        word = index2word[provisional[i]]
+        voc.word2index[word] = voc.num_words
+        voc.word2count[word] = int(counts[i])
+        voc.index2word[voc.num_words] = word
+        voc.num_words += 1
+    ids = remap[arrays.ids]
+    arrays = PairArrays(ids.astype(smallestIntType(voc.num_words - 1)), arrays.query_offsets,
+                        arrays.query_lengths, arrays.response_lengths)
+    return voc, arrays
+
+
+# Using the functions defined above, return a populated voc object and PairArrays
+def loadPrepareArrays(corpus, corpus_name, datafile, save_dir):
+    print("Start preparing training data ...")
+    _, pairs = readVocs(datafile, corpus_name)
+    print("Read {!s} sentence pairs".format(len(pairs)))
+    index2word = []
+    arrays = PairArrays.fromPairs(pairs, {}, index2word)
+    del pairs
+    arrays = filterPairArrays(arrays)
+    print("Trimmed to {!s} sentence pairs".format(len(arrays)))
+    print("Counting words...")
+    voc, arrays = vocFromArrays(corpus_name, arrays, index2word)
+    print("Counted words:", voc.num_words)
+    return voc, arrays
+
+
+def trimRemap(voc, MIN_COUNT):
+    '''
+    Trims words used under MIN_COUNT from voc and returns an array
+    mapping each old id to its new one, or to -1 for trimmed words.
+    '''
+    old_index2word = voc.index2word
+    voc.trim(MIN_COUNT)
+    remap = np.full(len(old_index2word), -1, dtype=np.int64)
+    for index, word in old_index2word.items():
+        remap[index] = voc.word2index.get(word, -1)
+    return remap
+
+
+def untrimmedPairs(arrays, ids):
+    '''
+    Indices of the pairs of `arrays` whose remapped `ids` contain no
+    trimmed (-1) word in their input or output sentence.
+    '''
+    query_missing, response_missing = arrays.segmentSums(ids < 0)
+    return np.flatnonzero((query_missing == 0) & (response_missing == 0))
+
+
+def trimRareWordArrays(voc, arrays, MIN_COUNT):
+    '''Vectorized trimRareWords over PairArrays.'''
+    ids = trimRemap(voc, MIN_COUNT)[arrays.ids]
+    keep = untrimmedPairs(arrays, ids)
+    trimmed = PairArrays(ids, arrays.query_offsets, arrays.query_lengths,
+                         arrays.response_lengths).subset(keep)
+    print(
+        f"Trimmed from {len(arrays)} pairs to {len(trimmed)}, {round(len(trimmed) / len(arrays), 4)} of total"
+    )
+    return trimmed
+
+
+def loadTrimmedArrays(datafile, voc=None):
+    '''
+    loadPrepareArrays and trimRareWordArrays on a formatted file. If
+    voc (say, from a checkpoint) is given, raises ValueError unless the
+    file produces the same vocabulary. Returns voc and the PairArrays.
+    '''
+    data_voc, pairs = loadPrepareArrays(None, corpus_name, datafile, None)
+    pairs = trimRareWordArrays(data_voc, pairs, MIN_COUNT)
+    if voc is not None and data_voc.word2index != voc.word2index:
+        raise ValueError("{} does not produce the checkpoint's vocabulary".format(datafile))
+    return data_voc, pairs
+
+
+def padSegments(ids, offsets, lengths):
+    '''
+    Gathers the given segments of ids, appends EOS_token and zero-pads
+    them. Returns an int64 array of shape (max_length, batch_size) and
+    the lengths including EOS.
+    '''
+    lengths = lengths.astype(np.int64) + 1
+    steps = np.arange(lengths.max())
+    inside = steps[None, :] < (lengths - 1)[:, None]
+    positions = offsets.astype(np.int64)[:, None] + steps[None, :]
+    padded = np.full(inside.shape, PAD_token, dtype=np.int64)
+    padded[inside] = ids[positions[inside]]
+    padded[np.arange(len(lengths)), lengths - 1] = EOS_token
+    return np.ascontiguousarray(padded.T), lengths
+
+
+def outputVarArrays(arrays, indices):
+    '''outputVar for the responses of the given pairs of PairArrays.'''
+    output, _ = padSegments(arrays.ids, arrays.responseOffsets(indices), arrays.response_lengths[indices])
+    return torch.from_numpy(output), torch.from_numpy(output != PAD_token), output.shape[0]
+
+
+def batch2TrainDataArrays(arrays, indices):
+    '''
+    batch2TrainData for PairArrays: indexes straight into the flat
+    arrays instead of splitting strings. Returns the same tuple.
+    '''
+    indices = np.asarray(indices, dtype=np.int64)
+    # Sort by query length, longest first, keeping ties in sampling order
+    indices = indices[np.argsort(-arrays.query_lengths[indices].astype(np.int64), kind="stable")]
+    inp, lengths = padSegments(arrays.ids, arrays.query_offsets[indices], arrays.query_lengths[indices])
+    return (torch.from_numpy(inp), torch.from_numpy(lengths)) + outputVarArrays(arrays, indices)
+
+
+'''
+randomBatch, splitPairs and evaluateLoss take either a list of string
+pairs or a dataset. A dataset is PairArrays or anything with the same
+interface:
+
+    len(pairs)             number of pairs
+    pairs.query_lengths    NumPy array with the length of every query
+    pairs.subset(indices)  a dataset of the given pairs, in that order
+    pairs.batch(indices)   the batch tuple train() takes, for those pairs
+
+bertstore.FeaturePairs and ingest.ShardedPairs are the other datasets.
+'''
+
+
+# Returns a random training batch from string pairs or a dataset
+def randomBatch(voc, pairs, batch_size):
+    if isinstance(pairs, list):
+        return batch2TrainData(voc, [random.choice(pairs) for _ in range(batch_size)])
+    return pairs.batch([random.randrange(len(pairs)) for _ in range(batch_size)])
 
-print("input_variable:", input_variable)
-print("lengths:", lengths)
-print("target_variable:", target_variable)
-print("mask:", mask)
-print("max_target_len:", max_target_len)
 
 '''DEFINE MODELS'''
 
@@ -454,20 +698,29 @@ print("max_target_len:", max_target_len)
 
 
 class EncoderRNN(nn.Module):
-    def __init__(self, hidden_size, embedding, n_layers=1, dropout=0):
+    def __init__(self, hidden_size, embedding, n_layers=1, dropout=0, feature_size=None):
         super(EncoderRNN, self).__init__()
         self.n_layers = n_layers
         self.hidden_size = hidden_size
         self.embedding = embedding
 
+        # With feature_size set, the encoder consumes precomputed features
+        #   (e.g. BERT outputs, see bertstore.py) of that size instead of word indexes
+        self.feature_size = feature_size
+        self.feature_proj = nn.Linear(feature_size, hidden_size) if feature_size else None
+
         # Initialize GRU; the input_size and hidden_size params are both set to 'hidden_size'
         #   because our input size is a word embedding with number of features == hidden_size
         self.gru = nn.GRU(hidden_size, hidden_size, n_layers,
                           dropout=(0 if n_layers == 1 else dropout), bidirectional=True)
 
     def forward(self, input_seq, input_lengths, hidden=None):
-        # Convert word indexes to embeddings
-        embedded = self.embedding(input_seq)
+        if self.feature_proj is not None:
+            # Project (max_length, batch_size, feature_size) features to hidden_size
+            embedded = self.feature_proj(input_seq)
+        else:
+            # Convert word indexes to embeddings
+            embedded = self.embedding(input_seq)
         # Pack padded batch of sequences for RNN module
         packed = nn.utils.rnn.pack_padded_sequence(embedded, input_lengths)
         # Forward pass through GRU
@@ -508,7 +761,7 @@ class Attn(nn.Module):
         energy = self.attn(torch.cat((hidden.expand(encoder_output.size(0), -1, -1), encoder_output), 2)).tanh()
         return torch.sum(self.v * energy, dim=2)
 
-    def forward(self, hidden, encoder_outputs):
+    def forward(self, hidden, encoder_outputs, mask=None):
         # Calculate the attention weights (energies) based on the given method
         if self.method == 'general':
             attn_energies = self.general_score(hidden, encoder_outputs)
@@ -519,6 +772,9 @@ class Attn(nn.Module):
 
         # Transpose max_length and batch_size dimensions
         attn_energies = attn_energies.t()
+        # Padded positions of shorter inputs in a batch get no weight
+        if mask is not None:
+            attn_energies = attn_energies.masked_fill(~mask, float("-inf"))
 
         # Return the softmax normalized probability scores (with added dimension)
         return F.softmax(attn_energies, dim=1).unsqueeze(1)
@@ -547,15 +803,16 @@ class LuongAttnDecoderRNN(nn.Module):
 
         self.attn = Attn(attn_model, hidden_size)
 
-    def forward(self, input_step, last_hidden, encoder_outputs):
+    def forward(self, input_step, last_hidden, encoder_outputs, encoder_mask=None):
         # Note: we run this one step (word) at a time
+        # encoder_mask: optional (batch_size, max_length) bool, True on real input steps
         # Get embedding of current input word
         embedded = self.embedding(input_step)
         embedded = self.embedding_dropout(embedded)
         # Forward through unidirectional GRU
         rnn_output, hidden = self.gru(embedded, last_hidden)
         # Calculate attention weights from the current GRU output
-        attn_weights = self.attn(rnn_output, encoder_outputs)
+        attn_weights = self.attn(rnn_output, encoder_outputs, encoder_mask)
         # Multiply attention weights to encoder outputs to get new "weighted sum" context vector
         context = attn_weights.bmm(encoder_outputs.transpose(0, 1))
         # Concatenate weighted context vector and GRU output using Luong eq. 5
@@ -587,7 +844,9 @@ def maskNLLLoss(inp, target, mask):
 
 
 def train(input_variable, lengths, target_variable, mask, max_target_len, encoder, decoder, embedding,
-          encoder_optimizer, decoder_optimizer, batch_size, clip, max_length=MAX_LENGTH):
+          encoder_optimizer, decoder_optimizer, batch_size, clip, max_length=MAX_LENGTH,
+          teacher_forcing_ratio=1.0, instrumentation=NULL_INSTRUMENTATION):
+    phase = instrumentation.phase
 
     # Zero gradients
     encoder_optimizer.zero_grad()
@@ -605,7 +864,8 @@ def train(input_variable, lengths, target_variable, mask, max_target_len, encode
     n_totals = 0
 
     # Forward pass through encoder
-    encoder_outputs, encoder_hidden = encoder(input_variable, lengths)
+    with phase("encoder"):
+        encoder_outputs, encoder_hidden = encoder(input_variable, lengths)
 
     # Create initial decoder input (start with SOS tokens for each sentence)
     decoder_input = torch.LongTensor([[SOS_token for _ in range(batch_size)]])
@@ -618,58 +878,73 @@ def train(input_variable, lengths, target_variable, mask, max_target_len, encode
     use_teacher_forcing = True if random.random() < teacher_forcing_ratio else False
 
     # Forward batch of sequences through decoder one time step at a time
-    if use_teacher_forcing:
-        for t in range(max_target_len):
-            decoder_output, decoder_hidden = decoder(
-                decoder_input, decoder_hidden, encoder_outputs
-            )
-            # Teacher forcing: next input is current target
-            decoder_input = target_variable[t].view(1, -1)
-            # Calculate and accumulate loss
-            mask_loss, nTotal = maskNLLLoss(decoder_output, target_variable[t], mask[t])
-            loss += mask_loss
-            print_losses.append(mask_loss.item() * nTotal)
-            n_totals += nTotal
-    else:
-        for t in range(max_target_len):
-            decoder_output, decoder_hidden = decoder(
-                decoder_input, decoder_hidden, encoder_outputs
-            )
-            # No teacher forcing: next input is decoder's own current output
-            _, topi = decoder_output.topk(1)
-            decoder_input = torch.LongTensor([[topi[i][0] for i in range(batch_size)]])
-            decoder_input = decoder_input.to(device)
-            # Calculate and accumulate loss
-            mask_loss, nTotal = maskNLLLoss(decoder_output, target_variable[t], mask[t])
-            loss += mask_loss
-            print_losses.append(mask_loss.item() * nTotal)
-            n_totals += nTotal
+    with phase("decoder"):
+        if use_teacher_forcing:
+            for t in range(max_target_len):
+                decoder_output, decoder_hidden = decoder(
+                    decoder_input, decoder_hidden, encoder_outputs
+                )
+                # Teacher forcing: next input is current target
+                decoder_input = target_variable[t].view(1, -1)
+                # Calculate and accumulate loss
+                mask_loss, nTotal = maskNLLLoss(decoder_output, target_variable[t], mask[t])
+                loss += mask_loss
+                print_losses.append(mask_loss.item() * nTotal)
+                n_totals += nTotal
+        else:
+            for t in range(max_target_len):
+                decoder_output, decoder_hidden = decoder(
+                    decoder_input, decoder_hidden, encoder_outputs
+                )
+                # No teacher forcing: next input is decoder's own current output
+                _, topi = decoder_output.topk(1)
+                decoder_input = torch.LongTensor([[topi[i][0] for i in range(batch_size)]])
+                decoder_input = decoder_input.to(device)
+                # Calculate and accumulate loss
+                mask_loss, nTotal = maskNLLLoss(decoder_output, target_variable[t], mask[t])
+                loss += mask_loss
+                print_losses.append(mask_loss.item() * nTotal)
+                n_totals += nTotal
 
     # Perform backpropatation
-    loss.backward()
+    with phase("backward"):
+        loss.backward()
 
     # Clip gradients: gradients are modified in place
-    _ = nn.utils.clip_grad_norm_(encoder.parameters(), clip)
-    _ = nn.utils.clip_grad_norm_(decoder.parameters(), clip)
+    with phase("clip"):
+        encoder_grad_norm = nn.utils.clip_grad_norm_(encoder.parameters(), clip)
+        decoder_grad_norm = nn.utils.clip_grad_norm_(decoder.parameters(), clip)
 
     # Adjust model weights
-    encoder_optimizer.step()
-    decoder_optimizer.step()
+    with phase("step"):
+        encoder_optimizer.step()
+        decoder_optimizer.step()
+
+    if instrumentation.enabled:
+        instrumentation.record(input_tokens=lengths.sum().item(), target_tokens=n_totals,
+                               # Time steps x batch; feature inputs also have a feature dimension
+                               padded_tokens=input_variable.shape[0] * input_variable.shape[1]
+                               + target_variable.numel(),
+                               decoder_steps=max_target_len, encoder_grad_norm=encoder_grad_norm,
+                               decoder_grad_norm=decoder_grad_norm)
 
     return sum(print_losses) / n_totals
 
 
-def trainIters(model_name, voc, pairs, encoder, decoder, encoder_optimizer, decoder_optimizer, embedding, encoder_n_layers, decoder_n_layers, save_dir, n_iteration, batch_size, print_every, save_every, clip, corpus_name, loadFilename):
+def trainIters(model_name, voc, pairs, encoder, decoder, encoder_optimizer, decoder_optimizer, embedding, encoder_n_layers, decoder_n_layers, save_dir, n_iteration, batch_size, print_every, save_every, clip, corpus_name, loadFilename,
+               teacher_forcing_ratio=1.0, instrumentation=NULL_INSTRUMENTATION,
+               valid_pairs=None, valid_every=0, valid_batch_size=1024):
     '''
     Run n_iterations of training given the passed parameters.
     Save a tarball containing the encoder and decoder state_dicts (parameters),
       the optimizers’ state_dicts, the loss, the iteration, and other model data.
       After loading a checkpoint, use model parameters
       to run inference, or resume training.
+    Pass a TrainingInstrumentation (see instrumentation.py) to record
+      per-phase timings and throughput metrics.
+    Pass valid_pairs and valid_every to run evaluateLoss on the
+      held-out pairs every valid_every iterations.
     '''
-    # Load batches for each iteration
-    training_batches = [batch2TrainData(voc, [random.choice(pairs) for _ in range(batch_size)])
-                      for _ in range(n_iteration)]
 
     # Initializations
     print('Initializing ...')
@@ -681,13 +956,17 @@ def trainIters(model_name, voc, pairs, encoder, decoder, encoder_optimizer, deco
     # Training loop
     print("Training...")
     for iteration in range(start_iteration, n_iteration + 1):
-        training_batch = training_batches[iteration - 1]
+        instrumentation.startIteration(iteration)
+        # Load batch for this iteration
+        with instrumentation.phase("batch"):
+            training_batch = randomBatch(voc, pairs, batch_size)
         # Extract fields from batch
         input_variable, lengths, target_variable, mask, max_target_len = training_batch
 
         # Run a training iteration with batch
         loss = train(input_variable, lengths, target_variable, mask, max_target_len, encoder,
-                     decoder, embedding, encoder_optimizer, decoder_optimizer, batch_size, clip)
+                     decoder, embedding, encoder_optimizer, decoder_optimizer, batch_size, clip,
+                     teacher_forcing_ratio=teacher_forcing_ratio, instrumentation=instrumentation)
         print_loss += loss
 
         # Print progress
@@ -696,9 +975,19 @@ def trainIters(model_name, voc, pairs, encoder, decoder, encoder_optimizer, deco
             print("Iteration: {}; Percent complete: {:.1f}%; Average loss: {:.4f}".format(iteration, iteration / n_iteration * 100, print_loss_avg))
             print_loss = 0
 
+        # Evaluate on held-out pairs
+        if valid_pairs is not None and valid_every and iteration % valid_every == 0:
+            with instrumentation.phase("validation"):
+                metrics = evaluateLoss(encoder, decoder, voc, valid_pairs, valid_batch_size)
+            print("Validation: NLL {:.4f}; perplexity {:.2f}; accuracy {:.4f}; {:.2f}s".format(
+                metrics['nll'], metrics['perplexity'], metrics['accuracy'], metrics['seconds']))
+            instrumentation.validation(iteration, metrics)
+
+        instrumentation.endIteration(iteration, loss)
+
         # Save checkpoint
         if (iteration % save_every == 0):
-            directory = os.path.join(save_dir, model_name, corpus_name, '{}-{}_{}'.format(encoder_n_layers, decoder_n_layers, hidden_size))
+            directory = os.path.join(save_dir, model_name, corpus_name, '{}-{}_{}'.format(encoder_n_layers, decoder_n_layers, encoder.hidden_size))
             if not os.path.exists(directory):
                 os.makedirs(directory)
             torch.save({
@@ -713,6 +1002,117 @@ def trainIters(model_name, voc, pairs, encoder, decoder, encoder_optimizer, deco
             }, os.path.join(directory, '{}_{}.tar'.format(iteration, 'checkpoint')))
 
 
+# The training configuration of the __main__ block below; sweep.py,
+# autotune.py and benchmark.py start from it too
+DEFAULT_CONFIG = {
+    "attn_model": "concat",
+    "hidden_size": 500,
+    "encoder_n_layers": 2,
+    "decoder_n_layers": 2,
+    "dropout": 0.1,
+    "batch_size": 64,
+    "clip": 50.0,
+    "teacher_forcing_ratio": 1.0,
+    "learning_rate": 0.0001,
+    "decoder_learning_ratio": 5.0,
+    "n_iteration": 4000,
+    "seed": 0,
+}
+
+
+def buildModel(num_words, config, feature_size=None):
+    '''
+    Builds the shared embedding, encoder and decoder for a Voc of
+    num_words words, sized by the model keys of config (see
+    DEFAULT_CONFIG), on the current device. config may also set
+    "output_size" for a decoder with fewer output rows (prune.py).
+    '''
+    embedding = nn.Embedding(num_words, config["hidden_size"])
+    encoder = EncoderRNN(config["hidden_size"], embedding, config["encoder_n_layers"], config["dropout"],
+                         feature_size=feature_size)
+    decoder = LuongAttnDecoderRNN(config["attn_model"], embedding, config["hidden_size"],
+                                  config.get("output_size", num_words), config["decoder_n_layers"],
+                                  config["dropout"])
+    return embedding, encoder.to(device), decoder.to(device)
+
+
+'''VALIDATE'''
+
+
+# torch.inference_mode is only available from torch 1.9
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+
+def splitPairs(pairs, valid_fraction=0.05, seed=0):
+    '''
+    Deterministically splits pairs (a list or a dataset) into
+    training and validation sets. The same pairs, fraction and
+    seed always give the same split.
+    '''
+    order = np.random.RandomState(seed).permutation(len(pairs))
+    n_valid = int(round(len(pairs) * valid_fraction))
+    valid_indices = np.sort(order[:n_valid])
+    train_indices = np.sort(order[n_valid:])
+    if isinstance(pairs, list):
+        return [pairs[i] for i in train_indices], [pairs[i] for i in valid_indices]
+    return pairs.subset(train_indices), pairs.subset(valid_indices)
+
+
+def evaluateLoss(encoder, decoder, voc, pairs, batch_size=1024):
+    '''
+    Runs batched, teacher-forced passes over every pair and returns
+    the masked NLL per target token, its perplexity, the token
+    accuracy of the decoder's top prediction and the time taken.
+    Pairs are batched in order of query length to keep padding low.
+    '''
+    start = time.perf_counter()
+    was_training = encoder.training, decoder.training
+    encoder.eval()
+    decoder.eval()
+    if isinstance(pairs, list):
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0].split(" ")), reverse=True)
+    else:
+        order = np.argsort(-pairs.query_lengths.astype(np.int64), kind="stable")
+    total_nll = 0.0
+    total_correct = 0
+    total_tokens = 0
+    with inference_mode():
+        for first in range(0, len(order), batch_size):
+            indices = order[first:first + batch_size]
+            if isinstance(pairs, list):
+                batch = batch2TrainData(voc, [pairs[i] for i in indices])
+            else:
+                batch = pairs.batch(indices)
+            input_variable, lengths, target_variable, mask, max_target_len = batch
+            input_variable = input_variable.to(device)
+            target_variable = target_variable.to(device)
+            mask = mask.to(device)
+
+            encoder_outputs, encoder_hidden = encoder(input_variable, lengths)
+            decoder_input = torch.full((1, len(indices)), SOS_token, dtype=torch.long, device=device)
+            decoder_hidden = encoder_hidden[:decoder.n_layers]
+            for t in range(max_target_len):
+                decoder_output, decoder_hidden = decoder(decoder_input, decoder_hidden, encoder_outputs)
+                target = target_variable[t]
+                crossEntropy = -torch.log(torch.gather(decoder_output, 1, target.view(-1, 1)).squeeze(1))
+                total_nll += crossEntropy.masked_select(mask[t]).sum().item()
+                total_correct += ((decoder_output.argmax(dim=1) == target) & mask[t]).sum().item()
+                # Teacher forcing: next input is current target
+                decoder_input = target.view(1, -1)
+            total_tokens += mask.sum().item()
+    encoder.train(was_training[0])
+    decoder.train(was_training[1])
+    nll = total_nll / total_tokens if total_tokens else float("nan")
+    return {
+        'nll': nll,
+        'perplexity': math.exp(nll) if total_tokens else float("nan"),
+        'accuracy': total_correct / total_tokens if total_tokens else float("nan"),
+        'tokens': total_tokens,
+        'pairs': len(pairs),
+        'seconds': time.perf_counter() - start,
+    }
+
+
 '''GREEDY DECODING'''
 
 
@@ -726,24 +1126,30 @@ class GreedySearchDecoder(nn.Module):
         # Forward input through encoder model
         encoder_outputs, encoder_hidden = self.encoder(input_seq, input_length)
         # Prepare encoder's final hidden layer to be first hidden input to the decoder
-        decoder_hidden = encoder_hidden[:decoder.n_layers]
+        decoder_hidden = encoder_hidden[:self.decoder.n_layers]
+        # Inputs are (max_length, batch_size); a single sentence is a batch of one
+        batch_size = input_seq.size(1)
+        # Mask the padding of shorter inputs, so each answer matches decoding it alone
+        steps = torch.arange(encoder_outputs.size(0), device=device)
+        encoder_mask = steps.unsqueeze(0) < input_length.to(device).unsqueeze(1)
         # Initialize decoder input with SOS_token
-        decoder_input = torch.ones(1, 1, device=device, dtype=torch.long) * SOS_token
+        decoder_input = torch.ones(1, batch_size, device=device, dtype=torch.long) * SOS_token
         # Initialize tensors to append decoded words to
-        all_tokens = torch.zeros([0], device=device, dtype=torch.long)
-        all_scores = torch.zeros([0], device=device)
+        all_tokens = torch.zeros([0, batch_size], device=device, dtype=torch.long)
+        all_scores = torch.zeros([0, batch_size], device=device)
         # Iteratively decode one word token at a time
         for _ in range(max_length):
             # Forward pass through decoder
-            decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_outputs)
+            decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_outputs,
+                                                          encoder_mask)
             # Obtain most likely word token and its softmax score
             decoder_scores, decoder_input = torch.max(decoder_output, dim=1)
-            # Record token and score
-            all_tokens = torch.cat((all_tokens, decoder_input), dim=0)
-            all_scores = torch.cat((all_scores, decoder_scores), dim=0)
             # Prepare current token to be next decoder input (add a dimension)
             decoder_input = torch.unsqueeze(decoder_input, 0)
-        # Return collections of word tokens and scores
+            # Record token and score
+            all_tokens = torch.cat((all_tokens, decoder_input), dim=0)
+            all_scores = torch.cat((all_scores, torch.unsqueeze(decoder_scores, 0)), dim=0)
+        # Return collections of word tokens and scores, shaped (max_length, batch_size)
         return all_tokens, all_scores
 
 
@@ -765,6 +1171,32 @@ def evaluate(encoder, decoder, searcher, voc, sentence, max_length=MAX_LENGTH):
     return decoded_words
 
 
+def generateBatch(searcher, voc, sentences, max_length=MAX_LENGTH):
+    '''
+    Greedy-decodes a batch of normalized sentences at once.
+    Returns one list of words per sentence, cut at the first EOS.
+    Raises KeyError for words missing from voc, like evaluate.
+    '''
+    indexes = [indexesFromSentence(voc, sentence) for sentence in sentences]
+    # The encoder packs its input, so the batch must be sorted longest first
+    order = sorted(range(len(indexes)), key=lambda i: len(indexes[i]), reverse=True)
+    input_batch = torch.LongTensor(zeroPadding([indexes[i] for i in order])).to(device)
+    lengths = torch.tensor([len(indexes[i]) for i in order])
+    with inference_mode():
+        tokens, _ = searcher(input_batch, lengths, max_length)
+    tokens = tokens.cpu().numpy()
+    outputs = [None] * len(sentences)
+    for column, i in enumerate(order):
+        words = []
+        for token in tokens[:, column]:
+            if token == EOS_token:
+                break
+            if token != PAD_token:
+                words.append(voc.index2word[int(token)])
+        outputs[i] = words
+    return outputs
+
+
 def evaluateInput(encoder, decoder, searcher, voc):
     input_sentence = ''
     while(1):
@@ -785,19 +1217,100 @@ def evaluateInput(encoder, decoder, searcher, voc):
             print("Error: Encountered unknown word.")
 
 
+
+def loadModel(loadFilename, attn_model=DEFAULT_CONFIG['attn_model'], hidden_size=DEFAULT_CONFIG['hidden_size'],
+              encoder_n_layers=DEFAULT_CONFIG['encoder_n_layers'],
+              decoder_n_layers=DEFAULT_CONFIG['decoder_n_layers'], dropout=DEFAULT_CONFIG['dropout']):
+    '''
+    Rebuilds voc, embedding, encoder and decoder from a checkpoint for
+    inference. trainIters checkpoints do not store the model
+    configuration, so it must match the one used for training;
+    checkpoints written by prune.py carry their own 'config', which
+    takes precedence. Returns the models in eval mode on the current device.
+    '''
+    checkpoint = torch.load(loadFilename, map_location=device)
+    voc = Voc(corpus_name)
+    voc.__dict__ = checkpoint['voc_dict']
+    config = {'attn_model': attn_model, 'hidden_size': hidden_size, 'encoder_n_layers': encoder_n_layers,
+              'decoder_n_layers': decoder_n_layers, 'dropout': dropout}
+    config.update(checkpoint.get('config', {}))
+    embedding, encoder, decoder = buildModel(voc.num_words, config)
+    embedding.load_state_dict(checkpoint['embedding'])
+    encoder.load_state_dict(checkpoint['en'])
+    decoder.load_state_dict(checkpoint['de'])
+    encoder.eval()
+    decoder.eval()
+    return voc, embedding, encoder, decoder
+
+
 if __name__ == "__main__":
+    # Apply the thread settings `python autotune.py` saved for this host, if any
+    applyHostProfile("train")
+
+    # Set to a directory written by `python ingest.py` to train from its
+    # trimmed, shuffled on-disk shards instead of loading the corpus into memory
+    ingest_dir = None
+    if ingest_dir:
+        from ingest import loadIngested
+        voc, pairs = loadIngested(ingest_dir)
+    else:
+        # Load lines and conversations and write the formatted file
+        writeFormattedFile(corpus, datafile)
+
+        # Print a sample of lines
+        # print("\nSample lines from file:")
+        # heprintlines(datafile)
+
+        # Load/Assemble voc and pairs
+        print("Assembling pairs...")
+        voc, pairs = loadPrepareArrays(corpus, corpus_name, datafile, save_dir)
+        # Print some pairs to validate
+        # print("\npairs:")
+        # for pair in pairs.subset(range(10)).toPairs(voc):
+        #     print(pair)
+
+        # Trim voc and pairs
+        pairs = trimRareWordArrays(voc, pairs, MIN_COUNT)
+
+    # Set to a store directory built by `python bertstore.py build` to train the encoder on
+    # precomputed BERT features instead of its own word embeddings
+    bert_store_dir = None
+    feature_size = None
+    if bert_store_dir:
+        if ingest_dir:
+            pairs = pairs.toArrays()
+        from bertstore import BertFeatureStore, FeaturePairs
+        store = BertFeatureStore(bert_store_dir)
+        pairs = FeaturePairs(store, pairs)
+        feature_size = store.feature_size
+
+    # Hold out pairs for validation
+    valid_fraction = 0.05
+    pairs, valid_pairs = splitPairs(pairs, valid_fraction)
+    print("Training on {} pairs, validating on {}".format(len(pairs), len(valid_pairs)))
+
+    # Example for validation
+    small_batch_size = 5
+    batches = randomBatch(voc, pairs, small_batch_size)
+    input_variable, lengths, target_variable, mask, max_target_len = batches
+
+    print("input_variable:", input_variable)
+    print("lengths:", lengths)
+    print("target_variable:", target_variable)
+    print("mask:", mask)
+    print("max_target_len:", max_target_len)
+
     '''Configure models'''
     
     # Configure models
     model_name = 'cb_model_v02' # input("Enter model name: ")
-    attn_model = 'concat' # input("Enter attention model, default is 'dot'. (Alternatives: 'general', 'concat')")
-    # attn_model = 'general'
-    # attn_model = 'concat'
-    hidden_size = 500
-    encoder_n_layers = 2
-    decoder_n_layers = 2
-    dropout = 0.1
-    batch_size = 64
+    config = dict(DEFAULT_CONFIG)
+    # config['attn_model'] = 'general'
+    # config['attn_model'] = 'dot'
+    hidden_size = config['hidden_size']
+    encoder_n_layers = config['encoder_n_layers']
+    decoder_n_layers = config['decoder_n_layers']
+    batch_size = config['batch_size']
     
     # Set checkpoint to load from; set to None if starting from scratch
     loadFilename = None
@@ -822,31 +1335,32 @@ if __name__ == "__main__":
     
     
     print('Building encoder and decoder ...')
-    # Initialize word embeddings
-    embedding = nn.Embedding(voc.num_words, hidden_size)
+    # Initialize word embeddings and encoder & decoder models on the appropriate device
+    embedding, encoder, decoder = buildModel(voc.num_words, config, feature_size=feature_size)
     if loadFilename:
         embedding.load_state_dict(embedding_sd)
-    # Initialize encoder & decoder models
-    encoder = EncoderRNN(hidden_size, embedding, encoder_n_layers, dropout)
-    decoder = LuongAttnDecoderRNN(attn_model, embedding, hidden_size, voc.num_words, decoder_n_layers, dropout)
-    if loadFilename:
         encoder.load_state_dict(encoder_sd)
         decoder.load_state_dict(decoder_sd)
-    # Use appropriate device
-    encoder = encoder.to(device)
-    decoder = decoder.to(device)
     print('Models built and ready to go!')
     
     '''RUN MODEL'''
     
     # Configure training/optimization
-    clip = 50.0
-    teacher_forcing_ratio = 1.0
-    learning_rate = 0.0001
-    decoder_learning_ratio = 5.0
-    n_iteration = 4000
+    clip = config['clip']
+    teacher_forcing_ratio = config['teacher_forcing_ratio']
+    learning_rate = config['learning_rate']
+    decoder_learning_ratio = config['decoder_learning_ratio']
+    n_iteration = config['n_iteration']
     print_every = 1
     save_every = 500
+    # Set to a .jsonl path to record per-phase timings and throughput every metrics_every iterations
+    metrics_file = None
+    metrics_every = 100
+    # Set to (first, last) iterations to capture a torch.profiler trace
+    profile_window = None
+    # Evaluate on the held-out pairs every valid_every iterations (0 disables)
+    valid_every = 500
+    valid_batch_size = 1024
     
     # Ensure dropout layers are in train mode
     encoder.train()
@@ -871,11 +1385,19 @@ if __name__ == "__main__":
             if isinstance(v, torch.Tensor):
                 state[k] = v.cuda()
     
+    instrumentation = NULL_INSTRUMENTATION
+    if metrics_file or profile_window:
+        instrumentation = TrainingInstrumentation(metrics_file, interval=metrics_every,
+                                                  profile_window=profile_window)
+
     # Run training iterations
     print("Starting Training!")
     trainIters(model_name, voc, pairs, encoder, decoder, encoder_optimizer, decoder_optimizer,
                embedding, encoder_n_layers, decoder_n_layers, save_dir, n_iteration, batch_size,
-               print_every, save_every, clip, corpus_name, loadFilename)
+               print_every, save_every, clip, corpus_name, loadFilename,
+               teacher_forcing_ratio=teacher_forcing_ratio, instrumentation=instrumentation,
+               valid_pairs=valid_pairs, valid_every=valid_every, valid_batch_size=valid_batch_size)
+    instrumentation.close()
     
     # Set dropout layers to eval mode
     encoder.eval()
@@ -885,4 +1407,7 @@ if __name__ == "__main__":
     searcher = GreedySearchDecoder(encoder, decoder)
     
     # Begin chatting (uncomment and run the following line to begin)
-    evaluateInput(encoder, decoder, searcher, voc)
\ No newline at end of file
+    if feature_size:
+        print("Interactive chat needs live BERT features for each input; not available with bert_store_dir")
+    else:
+        evaluateInput(encoder, decoder, searcher, voc)
\ No newline at end of file
@@ -0,0 +1,74 @@
+'''
+Per-host CPU settings saved by autotune.py.
+
+The profile file maps host names to the thread and MKL-DNN settings
+that ran fastest there, for training ("train") and for serving
+("serve"). applyHostProfile applies this host's entry at startup; it
+has to run before any other torch work so the inter-op thread count
+can still be changed.
+'''
+
+import json
+import os
+import platform
+
+import torch
+
+
+# Can be overridden to share one profile file between checkouts
+PROFILE_FILE = os.environ.get("CHATBOT_AUTOTUNE_PROFILE", os.path.join("data", "autotune.json"))
+
+
+def hostKey():
+    return platform.node() or "default"
+
+
+def mkldnnAvailable():
+    return hasattr(torch.backends, "mkldnn") and torch.backends.mkldnn.is_available()
+
+
+def applySettings(settings):
+    '''Applies the thread and MKL-DNN settings of a profile entry to this process.'''
+    if settings.get("threads"):
+        torch.set_num_threads(settings["threads"])
+    if settings.get("interop_threads"):
+        try:
+            torch.set_num_interop_threads(settings["interop_threads"])
+        except RuntimeError:
+            # Can only be set before any inter-op parallel work has started
+            print("Could not set inter-op threads; keeping", torch.get_num_interop_threads())
+    if "mkldnn" in settings and mkldnnAvailable():
+        torch.backends.mkldnn.enabled = settings["mkldnn"]
+
+
+def loadHostProfile(path=PROFILE_FILE, host=None):
+    '''This host's entry of the profile file, or None.'''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f).get(host or hostKey())
+
+
+def saveHostProfile(profile, path=PROFILE_FILE, host=None):
+    profiles = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            profiles = json.load(f)
+    profiles[host or hostKey()] = profile
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+
+
+def applyHostProfile(role, path=PROFILE_FILE):
+    '''
+    Applies the settings tuned for this host and role ("train" or
+    "serve"), if any, and returns them.
+    '''
+    profile = loadHostProfile(path)
+    if not profile or role not in profile:
+        return None
+    settings = profile[role]
+    applySettings(settings)
+    print("Applied {} profile for {}: {}".format(role, hostKey(), settings))
+    return settings
@@ -0,0 +1,463 @@
+'''
+Out-of-core corpus ingestion.
+
+loadPrepareArrays reads the whole formatted file into memory, so the
+corpus has to fit in RAM. This module streams query/response pairs
+from one or more corpus sources through normalizeString and the
+MAX_LENGTH filter into sharded PairArrays on disk:
+
+1. Pairs are read, normalized, filtered and numbered shard by shard;
+   word counts are added up across shards as each one is written.
+2. Rare words are trimmed (as trimRareWordArrays does) and every kept
+   pair is scattered to a randomly chosen bucket file on disk.
+3. Each bucket, at most about --shard-pairs pairs, is loaded, shuffled
+   and saved as a final shard.
+
+Memory use is bounded by the shard size and the vocabulary, not by the
+size of the corpus. Sources are given as kind:path:
+
+    python ingest.py cornell:data/cornell_movie_dialogs_corpus tsv:data/extra.tsv --out data/ingested
+    python ingest.py jsonl:dialogs.jsonl --query-field prompt --response-field reply --out data/ingested
+
+A synthetic corpus in the Cornell format, `--scale` times the size of
+the real one, can be written to check that memory stays flat:
+
+    python ingest.py synthetic data/synthetic10 --scale 10
+'''
+
+import argparse
+import itertools
+import json
+import os
+import re
+import shutil
+import sys
+from array import array
+
+import numpy as np
+
+from chatbot import (
+    MAX_LENGTH, MIN_COUNT, MOVIE_LINES_FIELDS, MOVIE_CONVERSATIONS_FIELDS, Voc, PairArrays,
+    corpus_name, normalizeString, batch2TrainDataArrays, trimRemap, untrimmedPairs,
+)
+from instrumentation import peakRSSMegabytes
+
+
+META_FILE = "meta.json"
+ARRAY_FIELDS = ["ids", "query_offsets", "query_lengths", "response_lengths"]
+
+
+'''SOURCES'''
+
+
+class CorpusSource:
+    '''
+    A corpus that can be streamed as raw (query, response) pairs.
+    Subclasses implement pairs(); register them in SOURCES.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def pairs(self):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.path)
+
+
+class CornellSource(CorpusSource):
+    '''
+    The Cornell movie-dialogs corpus. Lines and conversations are read
+    one movie at a time, so only the lines of the current movie are
+    held in memory. Both files must be grouped by movie, in the same
+    order, as they are in the released corpus. Pairs come out in the
+    order extractSentencePairs gives them.
+    '''
+    def pairs(self):
+        lines_path = os.path.join(self.path, "movie_lines.txt")
+        conversations_path = os.path.join(self.path, "movie_conversations.txt")
+        movie_field = MOVIE_LINES_FIELDS.index("movieID")
+        conversation_movie_field = MOVIE_CONVERSATIONS_FIELDS.index("movieID")
+        utterance_id_pattern = re.compile("L[0-9]+")
+        with open(lines_path, "r", encoding="iso-8859-1") as lines_file, \
+                open(conversations_path, "r", encoding="iso-8859-1") as conversations_file:
+            line_groups = itertools.groupby(
+                (line.split(" +++$+++ ", len(MOVIE_LINES_FIELDS) - 1) for line in lines_file),
+                key=lambda values: values[movie_field])
+            conversation_groups = itertools.groupby(
+                (line.split(" +++$+++ ") for line in conversations_file),
+                key=lambda values: values[conversation_movie_field])
+            passed = set()
+            for movie, conversations in conversation_groups:
+                for line_movie, values in line_groups:
+                    if line_movie == movie:
+                        break
+                    passed.add(line_movie)
+                else:
+                    reason = "appears twice" if movie in passed else "has no lines"
+                    raise ValueError("{}: movie {} {} in movie_lines.txt; both files must be "
+                                     "grouped by movie in the same order".format(self.path, movie, reason))
+                passed.add(movie)
+                texts = {v[0]: v[-1] for v in values}
+                for conversation in conversations:
+                    line_ids = utterance_id_pattern.findall(conversation[-1])
+                    for query_id, response_id in zip(line_ids, line_ids[1:]):
+                        query = texts[query_id].strip()
+                        response = texts[response_id].strip()
+                        # Filter wrong samples (if one of the lines is empty)
+                        if query and response:
+                            yield query, response
+
+
+class TSVSource(CorpusSource):
+    '''One tab-separated query/response pair per line, like formatted_movie_lines.txt.'''
+    def pairs(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) >= 2:
+                    yield fields[0], fields[1]
+
+
+class JSONLSource(CorpusSource):
+    '''One JSON object per line, with the query and response under the given keys.'''
+    def __init__(self, path, query_field="query", response_field="response"):
+        super().__init__(path)
+        self.query_field = query_field
+        self.response_field = response_field
+
+    def pairs(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                yield record[self.query_field], record[self.response_field]
+
+
+SOURCES = {
+    "cornell": CornellSource,
+    "tsv": TSVSource,
+    "jsonl": JSONLSource,
+}
+
+
+def openSource(spec, **options):
+    '''Builds a source from a "kind:path" spec; options go to sources that accept them.'''
+    kind, sep, path = spec.partition(":")
+    if not sep or kind not in SOURCES:
+        raise ValueError("{!r} is not a kind:path source (kinds: {})".format(spec, ", ".join(sorted(SOURCES))))
+    if SOURCES[kind] is JSONLSource:
+        return JSONLSource(path, **options)
+    return SOURCES[kind](path)
+
+
+'''SHARDS'''
+
+
+def saveArrays(directory, arrays):
+    os.makedirs(directory, exist_ok=True)
+    for field in ARRAY_FIELDS:
+        np.save(os.path.join(directory, field + ".npy"), getattr(arrays, field))
+
+
+def loadArrays(directory, mmap_mode="r"):
+    '''PairArrays backed by the memory-mapped files of a saved shard.'''
+    return PairArrays(*(np.load(os.path.join(directory, field + ".npy"), mmap_mode=mmap_mode)
+                        for field in ARRAY_FIELDS))
+
+
+def shardName(i):
+    return "shard-{:05d}".format(i)
+
+
+class ShardWriter:
+    '''
+    Numbers normalized pairs with a growing word2index and writes them
+    out as a PairArrays shard every `shard_pairs` pairs. Ids are final
+    Voc ids: words are numbered in order of first appearance, after
+    PAD, SOS and EOS, exactly as vocFromArrays would number them.
+    '''
+    def __init__(self, directory, shard_pairs):
+        self.directory = directory
+        self.shard_pairs = shard_pairs
+        self.word2index = {}
+        self.index2word = {}
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.shards = []
+        self.peak_rss_mb = []
+        self._reset()
+
+    def _reset(self):
+        self.ids = array("I")
+        self.query_lengths = array("H")
+        self.response_lengths = array("H")
+
+    def add(self, query_words, response_words):
+        for words, lengths in ((query_words, self.query_lengths), (response_words, self.response_lengths)):
+            for word in words:
+                index = self.word2index.get(word)
+                if index is None:
+                    index = self.word2index[word] = len(self.word2index) + 3
+                    self.index2word[index] = word
+                self.ids.append(index)
+            lengths.append(len(words))
+        if len(self.query_lengths) >= self.shard_pairs:
+            self.flush()
+
+    def flush(self):
+        if not self.query_lengths:
+            return
+        ids = np.frombuffer(self.ids, dtype=np.uint32)
+        # Add this shard's counts to the running totals
+        shard_counts = np.bincount(ids, minlength=len(self.word2index) + 3)
+        self.counts = np.concatenate([self.counts, np.zeros(len(shard_counts) - len(self.counts), np.int64)])
+        self.counts += shard_counts
+        arrays = PairArrays.fromSegments(ids, np.frombuffer(self.query_lengths, dtype=np.uint16),
+                                         np.frombuffer(self.response_lengths, dtype=np.uint16))
+        path = os.path.join(self.directory, shardName(len(self.shards)))
+        saveArrays(path, arrays)
+        self.shards.append((path, len(arrays)))
+        self._reset()
+        self.peak_rss_mb.append(peakRSSMegabytes())
+
+    def voc(self, name):
+        '''The untrimmed Voc of everything written so far.'''
+        voc = Voc(name)
+        for index in range(3, len(self.word2index) + 3):
+            word = self.index2word[index]
+            voc.word2index[word] = index
+            voc.word2count[word] = int(self.counts[index])
+            voc.index2word[index] = word
+        voc.num_words = len(self.word2index) + 3
+        return voc
+
+
+def streamShards(sources, directory, shard_pairs, max_length=MAX_LENGTH):
+    '''Stage 1: normalizes, filters and numbers every pair of every source.'''
+    writer = ShardWriter(directory, shard_pairs)
+    read = 0
+    for source in sources:
+        print("Reading", source)
+        for query, response in source.pairs():
+            read += 1
+            query_words = normalizeString(query).split(" ")
+            response_words = normalizeString(response).split(" ")
+            # Same condition as filterPair
+            if len(query_words) < max_length and len(response_words) < max_length:
+                writer.add(query_words, response_words)
+    writer.flush()
+    return writer, read
+
+
+def scatterShards(shards, remap, directory, n_buckets, seed=0):
+    '''
+    Stage 2: drops pairs with trimmed words and appends every other
+    pair to a random bucket. Buckets are raw files: uint32 ids and
+    uint16 (query_length, response_length) rows.
+    '''
+    rng = np.random.RandomState(seed)
+    names = [os.path.join(directory, "bucket-{:05d}".format(bucket)) for bucket in range(n_buckets)]
+    for name in names:
+        for suffix in (".ids", ".lengths"):
+            open(name + suffix, "wb").close()
+    kept = 0
+    for path, _ in shards:
+        arrays = loadArrays(path)
+        ids = remap[arrays.ids]
+        keep = untrimmedPairs(arrays, ids)
+        arrays = PairArrays(ids, arrays.query_offsets, arrays.query_lengths, arrays.response_lengths)
+        # Group the kept pairs by bucket, so each bucket's ids are one contiguous run
+        buckets = rng.randint(n_buckets, size=len(keep))
+        order = np.argsort(buckets, kind="stable")
+        grouped = arrays.subset(keep[order])
+        bounds = np.zeros(n_buckets + 1, dtype=np.int64)
+        np.cumsum(np.bincount(buckets, minlength=n_buckets), out=bounds[1:])
+        id_bounds = np.append(grouped.query_offsets.astype(np.int64), len(grouped.ids))[bounds]
+        lengths = np.stack([grouped.query_lengths, grouped.response_lengths], axis=1).astype(np.uint16)
+        for bucket, name in enumerate(names):
+            with open(name + ".ids", "ab") as f:
+                grouped.ids[id_bounds[bucket]:id_bounds[bucket + 1]].astype(np.uint32).tofile(f)
+            with open(name + ".lengths", "ab") as f:
+                lengths[bounds[bucket]:bounds[bucket + 1]].tofile(f)
+        kept += len(keep)
+        del arrays, ids, grouped
+        shutil.rmtree(path)
+    return kept
+
+
+def shuffleBuckets(directory, n_buckets, seed=0):
+    '''Stage 3: shuffles each bucket in memory and saves it as a final shard.'''
+    rng = np.random.RandomState(seed + 1)
+    shards = []
+    peak_rss_mb = []
+    for bucket in range(n_buckets):
+        name = os.path.join(directory, "bucket-{:05d}".format(bucket))
+        ids = np.fromfile(name + ".ids", dtype=np.uint32)
+        lengths = np.fromfile(name + ".lengths", dtype=np.uint16).reshape(-1, 2)
+        arrays = PairArrays.fromSegments(ids, lengths[:, 0], lengths[:, 1])
+        if len(arrays):
+            arrays = arrays.subset(rng.permutation(len(arrays)))
+            saveArrays(os.path.join(directory, shardName(len(shards))), arrays)
+            shards.append({"name": shardName(len(shards)), "pairs": len(arrays), "tokens": len(arrays.ids)})
+        del ids, lengths, arrays
+        os.remove(name + ".ids")
+        os.remove(name + ".lengths")
+        peak_rss_mb.append(peakRSSMegabytes())
+    return shards, peak_rss_mb
+
+
+def ingest(sources, directory, shard_pairs=500000, min_count=MIN_COUNT, max_length=MAX_LENGTH,
+           name=corpus_name, seed=0):
+    '''
+    Streams `sources` into shuffled, trimmed shards under `directory`
+    and writes the trimmed vocabulary and statistics to meta.json.
+    Returns the metadata.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    raw_directory = os.path.join(directory, "raw")
+    os.makedirs(raw_directory, exist_ok=True)
+    writer, read = streamShards(sources, raw_directory, shard_pairs, max_length)
+    filtered = sum(pairs for _, pairs in writer.shards)
+    print("Read {} sentence pairs, kept {} under {} words in {} shards".format(
+        read, filtered, max_length, len(writer.shards)))
+
+    voc = writer.voc(name)
+    untrimmed_words = voc.num_words
+    remap = trimRemap(voc, min_count)
+    n_buckets = max(1, -(-filtered // shard_pairs))
+    kept = scatterShards(writer.shards, remap, directory, n_buckets, seed)
+    os.rmdir(raw_directory)
+    shards, shuffle_rss = shuffleBuckets(directory, n_buckets, seed)
+    print("Trimmed to {} pairs and {} words in {} shards".format(kept, voc.num_words, len(shards)))
+
+    meta = {
+        "name": name,
+        "sources": [repr(source) for source in sources],
+        "read_pairs": read,
+        "filtered_pairs": filtered,
+        "pairs": kept,
+        "untrimmed_words": untrimmed_words,
+        "min_count": min_count,
+        "max_length": max_length,
+        "shards": shards,
+        "index2word": [voc.index2word[i] for i in range(voc.num_words)],
+        "word_counts": [voc.word2count.get(voc.index2word[i], 0) for i in range(voc.num_words)],
+        "peak_rss_mb": {"stream": writer.peak_rss_mb, "shuffle": shuffle_rss},
+    }
+    with open(os.path.join(directory, META_FILE), "w") as f:
+        json.dump(meta, f)
+    return meta
+
+
+'''LOADING'''
+
+
+class ShardedPairs:
+    '''
+    Memory-mapped shards written by ingest(), addressed as one dataset
+    (see chatbot.randomBatch). Only the pairs of each batch are read
+    from disk.
+    '''
+    def __init__(self, shards, rows=None):
+        self.shards = shards
+        sizes = np.array([len(shard) for shard in shards], dtype=np.int64)
+        self.starts = np.concatenate([[0], np.cumsum(sizes)])
+        self.rows = np.arange(self.starts[-1]) if rows is None else rows
+        all_lengths = (np.concatenate([np.asarray(shard.query_lengths) for shard in shards])
+                       if shards else np.zeros(0, dtype=np.uint8))
+        self.query_lengths = all_lengths[self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def subset(self, indices):
+        return ShardedPairs(self.shards, self.rows[np.asarray(indices, dtype=np.int64)])
+
+    def gather(self, indices):
+        '''Reads the given pairs into one in-memory PairArrays, in order.'''
+        rows = self.rows[np.asarray(indices, dtype=np.int64)]
+        shard_of = np.searchsorted(self.starts, rows, side="right") - 1
+        order = np.argsort(shard_of, kind="stable")
+        parts = [self.shards[s].subset(rows[order][shard_of[order] == s] - self.starts[s])
+                 for s in np.unique(shard_of)]
+        if not parts:
+            return PairArrays.fromSegments(np.zeros(0, dtype=np.int64), [], [])
+        grouped = PairArrays.fromSegments(np.concatenate([p.ids.astype(np.int64) for p in parts]),
+                                          np.concatenate([p.query_lengths for p in parts]),
+                                          np.concatenate([p.response_lengths for p in parts]))
+        # Undo the grouping by shard
+        return grouped.subset(np.argsort(order, kind="stable"))
+
+    def batch(self, indices):
+        return batch2TrainDataArrays(self.gather(indices), np.arange(len(indices)))
+
+    def toArrays(self):
+        '''All pairs as one in-memory PairArrays, for tools that need one.'''
+        return self.gather(np.arange(len(self)))
+
+
+def loadIngested(directory, mmap_mode="r"):
+    '''Returns the Voc and ShardedPairs written by ingest().'''
+    with open(os.path.join(directory, META_FILE)) as f:
+        meta = json.load(f)
+    voc = Voc(meta["name"])
+    voc.trimmed = True
+    for index, (word, count) in enumerate(zip(meta["index2word"], meta["word_counts"])):
+        voc.index2word[index] = word
+        if index >= 3:
+            voc.word2index[word] = index
+            voc.word2count[word] = count
+    voc.num_words = len(meta["index2word"])
+    shards = [loadArrays(os.path.join(directory, shard["name"]), mmap_mode) for shard in meta["shards"]]
+    return voc, ShardedPairs(shards)
+
+
+'''COMMAND LINE'''
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sources", nargs="+",
+                        help="kind:path corpus sources ({})".format(", ".join(sorted(SOURCES))))
+    parser.add_argument("--out", required=True, help="Output directory")
+    parser.add_argument("--shard-pairs", type=int, default=500000,
+                        help="Pairs per shard; bounds the memory of every stage")
+    parser.add_argument("--min-count", type=int, default=MIN_COUNT)
+    parser.add_argument("--max-length", type=int, default=MAX_LENGTH)
+    parser.add_argument("--name", default=corpus_name, help="Voc name")
+    parser.add_argument("--query-field", default="query", help="jsonl sources only")
+    parser.add_argument("--response-field", default="response", help="jsonl sources only")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def parseSyntheticArgs(argv):
+    parser = argparse.ArgumentParser(prog="ingest.py synthetic",
+                                     description="Write a synthetic corpus in the Cornell format")
+    parser.add_argument("out", help="Corpus directory")
+    parser.add_argument("--scale", type=int, default=10, help="Multiple of the real corpus size")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["synthetic"]:
+        from benchmark import FIXTURES, writeSyntheticCorpus
+        args = parseSyntheticArgs(argv[1:])
+        os.makedirs(args.out, exist_ok=True)
+        writeSyntheticCorpus(args.out, FIXTURES["cornell"] * args.scale, args.seed)
+        print("Wrote {}x Cornell corpus to {}".format(args.scale, args.out))
+        return 0
+    args = parseArgs(argv)
+    sources = [openSource(spec, query_field=args.query_field, response_field=args.response_field)
+               for spec in args.sources]
+    meta = ingest(sources, args.out, args.shard_pairs, args.min_count, args.max_length, args.name, args.seed)
+    print("Peak RSS (MB) after each shard:", meta["peak_rss_mb"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
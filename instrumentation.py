@@ -0,0 +1,278 @@
+'''
+Training-loop instrumentation.
+
+train() and trainIters() accept an `instrumentation` object and wrap
+each phase of an iteration (batch construction, encoder, decoder loop,
+backward, gradient clipping, optimizer step) in `instrumentation.phase`.
+The default, NULL_INSTRUMENTATION, does nothing, so an uninstrumented
+run only pays for entering a shared no-op context manager.
+
+TrainingInstrumentation accumulates per-phase wall time, non-pad
+tokens/sec, padding ratio, gradient norms and peak RSS, and writes one
+JSON line per `interval` iterations. It can also capture a
+torch.profiler trace for a window of iterations.
+'''
+
+import json
+import statistics
+import sys
+import time
+from contextlib import contextmanager
+
+import torch
+
+try:
+    import torch.profiler as torch_profiler
+except ImportError:  # torch < 1.8
+    torch_profiler = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class NullInstrumentation:
+    '''Does nothing; used when training is not instrumented.'''
+    enabled = False
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def record(self, input_tokens, target_tokens, padded_tokens, decoder_steps,
+               encoder_grad_norm, decoder_grad_norm):
+        pass
+
+    def startIteration(self, iteration):
+        pass
+
+    def endIteration(self, iteration, loss):
+        pass
+
+    def validation(self, iteration, metrics):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+def peakRSSMegabytes():
+    '''Peak resident set size of this process in MB, or None if unknown.'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+class TrainingInstrumentation(NullInstrumentation):
+    '''
+    Collects per-phase timings and throughput metrics for trainIters.
+
+    path: JSONL file to append records to (None prints them instead)
+    interval: number of iterations per record
+    profile_window: optional (first, last) iterations to capture with
+        torch.profiler; the trace is written to `profile_trace`. A run
+        resumed inside the window captures the rest of it
+    sync_cuda: synchronize before reading the clock so GPU work is
+        attributed to the phase that launched it
+    '''
+    enabled = True
+
+    def __init__(self, path=None, interval=100, profile_window=None,
+                 profile_trace="profile_trace.json", sync_cuda=None):
+        self.path = path
+        self.interval = interval
+        self.profile_window = profile_window
+        self.profile_trace = profile_trace
+        self.sync_cuda = torch.cuda.is_available() if sync_cuda is None else sync_cuda
+        self._file = open(path, "a") if path else None
+        self._profiler = None
+        self._profiled = False
+        self.last_iteration = 0
+        self.last_record = None
+        self.totals = {"iterations": 0, "seconds": 0.0, "tokens": 0, "padded_tokens": 0}
+        self._resetWindow()
+
+    def _resetWindow(self):
+        self.window_start = time.perf_counter()
+        self.phase_seconds = {}
+        self.iterations = 0
+        self.input_tokens = 0
+        self.target_tokens = 0
+        self.padded_tokens = 0
+        self.decoder_steps = 0
+        self.loss = 0.0
+        self.encoder_grad_norms = []
+        self.decoder_grad_norms = []
+
+    def _clock(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = self._clock()
+        if self._profiler is not None:
+            with torch_profiler.record_function(name):
+                yield
+        else:
+            yield
+        elapsed = self._clock() - start
+        self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + elapsed
+
+    def record(self, input_tokens, target_tokens, padded_tokens, decoder_steps,
+               encoder_grad_norm, decoder_grad_norm):
+        self.input_tokens += input_tokens
+        self.target_tokens += target_tokens
+        self.padded_tokens += padded_tokens
+        self.decoder_steps += decoder_steps
+        self.encoder_grad_norms.append(float(encoder_grad_norm))
+        self.decoder_grad_norms.append(float(decoder_grad_norm))
+
+    def startIteration(self, iteration):
+        if not self.profile_window or self._profiled:
+            return
+        first, last = self.profile_window
+        if first <= iteration <= last:
+            if iteration > first:
+                print("Profiling from iteration {} (window {}-{})".format(iteration, first, last))
+            self._startProfiler()
+        elif iteration > last:
+            print("Not profiling: training starts at iteration {}, after the window {}-{}".format(
+                iteration, first, last))
+        else:
+            return
+        self._profiled = True
+
+    def endIteration(self, iteration, loss):
+        self.last_iteration = iteration
+        self.iterations += 1
+        self.loss += loss
+        if self.profile_window and iteration >= self.profile_window[1]:
+            self._stopProfiler()
+        if self.iterations >= self.interval:
+            self.flush(iteration)
+
+    def validation(self, iteration, metrics):
+        '''Writes a validation record (see chatbot.evaluateLoss) straight away.'''
+        self._write(dict(metrics, iteration=iteration, kind="validation"))
+
+    def _write(self, record):
+        line = json.dumps(record, sort_keys=True)
+        if self._file is not None:
+            self._file.write(line + "\n")
+            self._file.flush()
+        else:
+            print(line)
+
+    def flush(self, iteration):
+        '''Emits a record for the iterations since the last flush.'''
+        if self.iterations == 0:
+            return None
+        elapsed = time.perf_counter() - self.window_start
+        tokens = self.input_tokens + self.target_tokens
+        self.totals["iterations"] += self.iterations
+        self.totals["seconds"] += elapsed
+        self.totals["tokens"] += tokens
+        self.totals["padded_tokens"] += self.padded_tokens
+        record = {
+            "kind": "training",
+            "iteration": iteration,
+            "iterations": self.iterations,
+            "seconds": elapsed,
+            "seconds_per_iteration": elapsed / self.iterations,
+            "phase_seconds": self.phase_seconds,
+            "loss": self.loss / self.iterations,
+            "tokens_per_sec": tokens / elapsed if elapsed > 0 else None,
+            "target_tokens_per_sec": self.target_tokens / elapsed if elapsed > 0 else None,
+            "padding_ratio": 1 - tokens / self.padded_tokens if self.padded_tokens else None,
+            "decoder_steps": self.decoder_steps,
+            "encoder_grad_norm": _summarize(self.encoder_grad_norms),
+            "decoder_grad_norm": _summarize(self.decoder_grad_norms),
+            "peak_rss_mb": peakRSSMegabytes(),
+        }
+        self._write(record)
+        self._resetWindow()
+        self.last_record = record
+        return record
+
+    def summary(self):
+        '''Throughput over every flushed window.'''
+        totals = dict(self.totals)
+        seconds = totals["seconds"]
+        totals["tokens_per_sec"] = totals["tokens"] / seconds if seconds > 0 else None
+        totals["padding_ratio"] = (1 - totals["tokens"] / totals["padded_tokens"]
+                                   if totals["padded_tokens"] else None)
+        totals["peak_rss_mb"] = peakRSSMegabytes()
+        return totals
+
+    def _startProfiler(self):
+        if torch_profiler is None:
+            raise RuntimeError("torch.profiler is not available in torch {}".format(torch.__version__))
+        activities = [torch_profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch_profiler.ProfilerActivity.CUDA)
+        self._profiler = torch_profiler.profile(activities=activities, record_shapes=True)
+        self._profiler.__enter__()
+
+    def _stopProfiler(self):
+        if self._profiler is None:
+            return
+        profiler, self._profiler = self._profiler, None
+        profiler.__exit__(None, None, None)
+        profiler.export_chrome_trace(self.profile_trace)
+        print("Wrote profiler trace to", self.profile_trace)
+
+    def close(self):
+        self._stopProfiler()
+        self.flush(self.last_iteration)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def timeStage(fn, repeats=3, warmup=0, setup=None):
+    '''
+    Calls fn `repeats` times (after `warmup` untimed calls) and
+    returns summary statistics in seconds. If setup is given, its
+    result is passed to fn and its own cost is not timed.
+    '''
+    timings = []
+    result = None
+    for i in range(warmup + repeats):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        result = fn(arg) if setup is not None else fn()
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            timings.append(elapsed)
+    return {
+        "median": statistics.median(timings),
+        "min": min(timings),
+        "mean": statistics.mean(timings),
+        "repeats": repeats,
+    }, result
+
+
+def _summarize(values):
+    if not values:
+        return None
+    return {"mean": sum(values) / len(values), "max": max(values)}
@@ -0,0 +1,247 @@
+'''
+Deployment-time vocabulary and output-layer pruning.
+
+The shared embedding and LuongAttnDecoderRNN.out carry one row per word
+of Voc, but many words only ever appear in queries, or in a handful of
+responses. This tool counts how often every word is used on the
+response side of the corpus and keeps an output row only for words used
+at least --min-response-count times (plus PAD, SOS and EOS). The
+compacted vocabulary puts the kept output words first, so output row i
+is still word i, followed by the words the encoder needs for queries;
+words used on neither side are dropped. The pruned model is saved
+without optimizer state, with its configuration, so loadModel can
+rebuild it on its own.
+
+The report compares the two checkpoints: file size, load time, latency
+of one decoder step and how often greedy decoding gives the same
+answer on held-out queries.
+
+    python prune.py data/save/.../4000_checkpoint.tar --out pruned.tar --min-response-count 2
+'''
+
+import argparse
+import json
+import os
+import random
+import sys
+
+import numpy as np
+import torch
+
+from chatbot import (
+    PAD_token, SOS_token, EOS_token, Voc, datafile,
+    GreedySearchDecoder, indexesFromSentence, zeroPadding, generateBatch,
+    loadModel, loadTrimmedArrays, splitPairs, inference_mode, device,
+)
+from instrumentation import timeStage
+from retrieval import gatherSegments, addModelArgs, loadModelFromArgs
+
+
+'''USAGE'''
+
+
+def tokenUsage(pairs, num_words):
+    '''Per-id counts over the queries and over the responses of `pairs` (PairArrays).'''
+    query_ids, _ = gatherSegments(pairs.ids, pairs.query_offsets, pairs.query_lengths)
+    response_ids, _ = gatherSegments(pairs.ids, pairs.responseOffsets(), pairs.response_lengths)
+    return (np.bincount(query_ids.astype(np.int64), minlength=num_words),
+            np.bincount(response_ids.astype(np.int64), minlength=num_words))
+
+
+def pruningPlan(query_counts, response_counts, min_response_count):
+    '''
+    Returns (new_to_old, output_size): the old id of every word of the
+    compacted vocabulary, output words first, and how many of them
+    keep an output row.
+    '''
+    keep_output = response_counts >= min_response_count
+    # PAD, SOS and EOS keep their ids and rows
+    keep_output[[PAD_token, SOS_token, EOS_token]] = True
+    input_only = (query_counts > 0) & ~keep_output
+    output_ids = np.flatnonzero(keep_output)
+    return np.concatenate([output_ids, np.flatnonzero(input_only)]), len(output_ids)
+
+
+'''PRUNE'''
+
+
+def compactVoc(voc, new_to_old):
+    pruned = Voc(voc.name)
+    pruned.trimmed = True
+    for new, old in enumerate(new_to_old):
+        word = voc.index2word[int(old)]
+        pruned.index2word[new] = word
+        if new > EOS_token:
+            pruned.word2index[word] = new
+            pruned.word2count[word] = voc.word2count.get(word, 0)
+    pruned.num_words = len(new_to_old)
+    return pruned
+
+
+def pruneModel(voc, embedding, encoder, decoder, new_to_old, output_size):
+    '''
+    Returns the compacted voc and an inference checkpoint dict with
+    the embedding and output rows selected by new_to_old.
+    '''
+    rows = torch.as_tensor(new_to_old, dtype=torch.long, device=embedding.weight.device)
+    output_rows = rows[:output_size]
+    pruned_embedding = {"weight": embedding.weight.detach()[rows].clone()}
+    encoder_state = encoder.state_dict()
+    encoder_state["embedding.weight"] = pruned_embedding["weight"]
+    decoder_state = decoder.state_dict()
+    decoder_state["embedding.weight"] = pruned_embedding["weight"]
+    decoder_state["out.weight"] = decoder.out.weight.detach()[output_rows].clone()
+    decoder_state["out.bias"] = decoder.out.bias.detach()[output_rows].clone()
+    pruned_voc = compactVoc(voc, new_to_old)
+    checkpoint = {
+        "en": encoder_state,
+        "de": decoder_state,
+        "embedding": pruned_embedding,
+        "voc_dict": pruned_voc.__dict__,
+        "config": {
+            "attn_model": decoder.attn_model,
+            "hidden_size": decoder.hidden_size,
+            "encoder_n_layers": encoder.n_layers,
+            "decoder_n_layers": decoder.n_layers,
+            "output_size": output_size,
+        },
+    }
+    return pruned_voc, checkpoint
+
+
+'''REPORT'''
+
+
+def stepLatency(encoder, decoder, voc, sentences, repeats=100):
+    '''Seconds for one decoder step on a batch of the given sentences.'''
+    indexes = sorted((indexesFromSentence(voc, s) for s in sentences), key=len, reverse=True)
+    input_batch = torch.LongTensor(zeroPadding(indexes)).to(device)
+    lengths = torch.tensor([len(i) for i in indexes])
+    with inference_mode():
+        encoder_outputs, encoder_hidden = encoder(input_batch, lengths)
+    decoder_hidden = encoder_hidden[:decoder.n_layers]
+    decoder_input = torch.full((1, len(indexes)), SOS_token, dtype=torch.long, device=device)
+    # Same padding mask as GreedySearchDecoder
+    steps = torch.arange(encoder_outputs.size(0), device=device)
+    encoder_mask = steps.unsqueeze(0) < lengths.to(device).unsqueeze(1)
+
+    def step():
+        with inference_mode():
+            decoder(decoder_input, decoder_hidden, encoder_outputs, encoder_mask)
+    stats, _ = timeStage(step, repeats, warmup=10)
+    return stats
+
+
+def greedyAgreement(full, pruned, sentences, batch_size=256):
+    '''
+    Decodes every sentence with both (searcher, voc) models and
+    compares the answers word by word.
+    '''
+    exact = matching = total = 0
+    for start in range(0, len(sentences), batch_size):
+        chunk = sentences[start:start + batch_size]
+        for a, b in zip(generateBatch(*full, chunk), generateBatch(*pruned, chunk)):
+            exact += a == b
+            matching += sum(x == y for x, y in zip(a, b))
+            total += max(len(a), len(b))
+    return {
+        "sentences": len(sentences),
+        "exact_match": exact / len(sentences) if sentences else None,
+        "token_agreement": matching / total if total else None,
+    }
+
+
+def countParameters(*modules):
+    '''Parameters of the modules, counting the shared embedding once.'''
+    unique = {id(p): p for module in modules for p in module.parameters()}
+    return sum(p.numel() for p in unique.values())
+
+
+def compareModels(original_path, pruned_path, model_args, sentences, step_batch_sizes, repeats):
+    report = {}
+    models = {}
+    for name, path, args in (("original", original_path, model_args), ("pruned", pruned_path, ())):
+        stats, (voc, _, encoder, decoder) = timeStage(lambda: loadModel(path, *args), repeats)
+        models[name] = (voc, encoder, decoder)
+        report[name] = {
+            "file_bytes": os.path.getsize(path),
+            "parameters": countParameters(encoder, decoder),
+            "num_words": voc.num_words,
+            "output_size": decoder.output_size,
+            "load_seconds": stats,
+            "step_seconds": {str(b): stepLatency(encoder, decoder, voc, sentences[:b])
+                             for b in step_batch_sizes},
+        }
+    report["agreement"] = greedyAgreement(
+        *((GreedySearchDecoder(encoder, decoder), voc) for voc, encoder, decoder
+          in (models["original"], models["pruned"])), sentences)
+    return report
+
+
+def printReport(report):
+    original, pruned = report["original"], report["pruned"]
+    rows = [("file MB", "file_bytes", 1 / 2 ** 20), ("parameters", "parameters", 1),
+            ("words", "num_words", 1), ("output rows", "output_size", 1)]
+    for label, key, scale in rows:
+        print("{:<24} {:>12.4g} -> {:>12.4g}".format(label, original[key] * scale, pruned[key] * scale))
+    print("{:<24} {:>12.4f} -> {:>12.4f}".format("load s (median)", original["load_seconds"]["median"],
+                                                  pruned["load_seconds"]["median"]))
+    for batch_size in original["step_seconds"]:
+        print("{:<24} {:>12.3f} -> {:>12.3f}".format(
+            "step ms, batch {}".format(batch_size),
+            original["step_seconds"][batch_size]["median"] * 1000,
+            pruned["step_seconds"][batch_size]["median"] * 1000))
+    agreement = report["agreement"]
+    print("greedy agreement on {} held-out queries: {:.2%} exact, {:.2%} of tokens".format(
+        agreement["sentences"], agreement["exact_match"], agreement["token_agreement"]))
+
+
+'''COMMAND LINE'''
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    addModelArgs(parser)
+    parser.add_argument("--out", required=True, help="Pruned checkpoint to write")
+    parser.add_argument("--datafile", default=datafile)
+    parser.add_argument("--min-response-count", type=int, default=1,
+                        help="Keep an output row for words used at least this often in responses")
+    parser.add_argument("--valid-fraction", type=float, default=0.05,
+                        help="Must match training; agreement is measured on the held-out queries")
+    parser.add_argument("--samples", type=int, default=1000, help="Held-out queries to compare")
+    parser.add_argument("--step-batch-sizes", type=int, nargs="+", default=[1, 64])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--report", default=None, help="Optional JSON report file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    voc, embedding, encoder, decoder = loadModelFromArgs(args)
+    _, pairs = loadTrimmedArrays(args.datafile, voc)
+
+    query_counts, response_counts = tokenUsage(pairs, voc.num_words)
+    new_to_old, output_size = pruningPlan(query_counts, response_counts, args.min_response_count)
+    pruned_voc, checkpoint = pruneModel(voc, embedding, encoder, decoder, new_to_old, output_size)
+    torch.save(checkpoint, args.out)
+    print("Kept {} of {} words, {} with an output row".format(pruned_voc.num_words, voc.num_words,
+                                                              output_size))
+
+    _, valid = splitPairs(pairs, args.valid_fraction)
+    sentences = [query for query, _ in valid.toPairs(voc)]
+    random.Random(0).shuffle(sentences)
+    sentences = sentences[:args.samples]
+    model_args = (args.attn_model, args.hidden_size, args.encoder_n_layers, args.decoder_n_layers)
+    report = compareModels(args.checkpoint, args.out, model_args, sentences,
+                           args.step_batch_sizes, args.repeats)
+    report["min_response_count"] = args.min_response_count
+    printReport(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,422 @@
+'''
+Nearest-neighbour retrieval over encoded training queries.
+
+Greedy generation is slow and often poor (see extremely-mvp), while
+many inputs are close to something already seen in training. The build
+step runs EncoderRNN in batches over every training query, mean-pools
+its outputs over the real (non-pad) time steps and stores the
+L2-normalized vectors in a memory-mapped .npy matrix, next to the
+matching responses. Queries are answered by a batched top-k cosine
+search: exact (one matmul per chunk of the matrix) or, if the index was
+built with --n-lists, restricted to the `nprobe` closest k-means
+partitions (IVF). Inputs whose best match is below a similarity
+threshold fall back to greedy generation.
+
+    python retrieval.py build data/save/.../4000_checkpoint.tar --out data/index --n-lists 256
+    python retrieval.py chat data/index data/save/.../4000_checkpoint.tar --threshold 0.9
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from chatbot import (
+    MAX_LENGTH, DEFAULT_CONFIG, datafile,
+    GreedySearchDecoder, indexesFromSentence, normalizeString, zeroPadding, generateBatch,
+    loadModel, loadTrimmedArrays, splitPairs, padSegments,
+    inference_mode, device,
+)
+from hostprofile import applyHostProfile
+
+
+VECTORS_FILE = "vectors.npy"
+META_FILE = "meta.json"
+
+
+'''ENCODE'''
+
+
+def encoderFingerprint(encoder):
+    '''SHA-256 of the encoder's parameters (shared embedding included).'''
+    digest = hashlib.sha256()
+    for name, tensor in sorted(encoder.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def poolEncoderOutputs(encoder_outputs, lengths):
+    '''
+    Mean of the encoder outputs (max_length, batch_size, hidden_size)
+    over each sentence's real time steps, L2-normalized.
+    '''
+    lengths = lengths.to(encoder_outputs.device)
+    steps = torch.arange(encoder_outputs.size(0), device=encoder_outputs.device).unsqueeze(1)
+    mask = (steps < lengths.unsqueeze(0)).unsqueeze(2).to(encoder_outputs.dtype)
+    pooled = (encoder_outputs * mask).sum(0) / lengths.unsqueeze(1).to(encoder_outputs.dtype)
+    return F.normalize(pooled, dim=1)
+
+
+def encodeBatch(encoder, input_batch, lengths):
+    '''Pooled vectors for a padded (max_length, batch_size) batch sorted by length.'''
+    with inference_mode():
+        encoder_outputs, _ = encoder(input_batch.to(device), lengths)
+        return poolEncoderOutputs(encoder_outputs, lengths).cpu().numpy()
+
+
+def encodeSentences(encoder, voc, sentences):
+    '''
+    Pooled vectors for normalized sentences, in the given order.
+    Raises KeyError for words missing from voc, like evaluate does.
+    '''
+    indexes = [indexesFromSentence(voc, sentence) for sentence in sentences]
+    order = sorted(range(len(indexes)), key=lambda i: len(indexes[i]), reverse=True)
+    input_batch = torch.LongTensor(zeroPadding([indexes[i] for i in order]))
+    lengths = torch.tensor([len(indexes[i]) for i in order])
+    vectors = np.empty((len(indexes), encoder.hidden_size), dtype=np.float32)
+    vectors[order] = encodeBatch(encoder, input_batch, lengths)
+    return vectors
+
+
+'''BUILD'''
+
+
+def gatherSegments(ids, offsets, lengths):
+    '''Copies the given segments of ids into one compact array; returns it and new offsets.'''
+    lengths = lengths.astype(np.int64)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(offsets.astype(np.int64) - starts, lengths)
+    return ids[positions], starts
+
+
+def kmeans(vectors, n_lists, iterations=10, sample=65536, seed=0):
+    '''
+    Spherical k-means on a sample of the (normalized) rows; returns
+    n_lists normalized centroids.
+    '''
+    rng = np.random.RandomState(seed)
+    rows = np.sort(rng.choice(len(vectors), min(len(vectors), sample), replace=False))
+    data = np.asarray(vectors[rows], dtype=np.float32)
+    centroids = data[rng.choice(len(data), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(data @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # Empty partitions keep their previous centroid
+        filled = norms[:, 0] > 0
+        centroids[filled] = sums[filled] / norms[filled]
+    return centroids
+
+
+def assignPartitions(vectors, centroids, chunk_size=65536):
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size])
+        assignments[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def buildPartitions(directory, vectors, n_lists, seed=0):
+    '''Writes centroids and the rows of each partition, grouped by partition.'''
+    n_lists = min(n_lists, len(vectors))
+    centroids = kmeans(vectors, n_lists, seed=seed)
+    assignments = assignPartitions(vectors, centroids)
+    list_rows = np.argsort(assignments, kind="stable")
+    list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignments, minlength=n_lists), out=list_offsets[1:])
+    np.save(os.path.join(directory, "centroids.npy"), centroids)
+    np.save(os.path.join(directory, "list_rows.npy"), list_rows)
+    np.save(os.path.join(directory, "list_offsets.npy"), list_offsets)
+    return n_lists
+
+
+def buildIndex(encoder, voc, pairs, directory, batch_size=1024, n_lists=0, seed=0, checkpoint=None):
+    '''
+    Encodes every query of `pairs` (PairArrays) into a memory-mapped
+    matrix under `directory` and stores the matching responses, the
+    words needed to print them and a fingerprint of the encoder (plus
+    the checkpoint path, if given). Returns build timings.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    timings = {}
+    start = time.perf_counter()
+    was_training = encoder.training
+    encoder.eval()
+    vectors = np.lib.format.open_memmap(os.path.join(directory, VECTORS_FILE), mode="w+",
+                                        dtype=np.float32, shape=(len(pairs), encoder.hidden_size))
+    # Longest queries first, so every batch is already sorted for pack_padded_sequence
+    order = np.argsort(-pairs.query_lengths.astype(np.int64), kind="stable")
+    for first in range(0, len(order), batch_size):
+        indices = order[first:first + batch_size]
+        input_batch, lengths = padSegments(pairs.ids, pairs.query_offsets[indices],
+                                           pairs.query_lengths[indices])
+        vectors[indices] = encodeBatch(encoder, torch.from_numpy(input_batch), torch.from_numpy(lengths))
+    vectors.flush()
+    encoder.train(was_training)
+    timings["encode_seconds"] = time.perf_counter() - start
+
+    response_ids, response_offsets = gatherSegments(pairs.ids, pairs.responseOffsets(),
+                                                    pairs.response_lengths)
+    np.save(os.path.join(directory, "response_ids.npy"), response_ids)
+    np.save(os.path.join(directory, "response_offsets.npy"), response_offsets)
+    np.save(os.path.join(directory, "response_lengths.npy"), pairs.response_lengths)
+
+    if n_lists:
+        start = time.perf_counter()
+        n_lists = buildPartitions(directory, vectors, n_lists, seed)
+        timings["partition_seconds"] = time.perf_counter() - start
+
+    meta = {
+        "size": len(pairs),
+        "hidden_size": encoder.hidden_size,
+        "encoder_sha256": encoderFingerprint(encoder),
+        "checkpoint": checkpoint,
+        "n_lists": n_lists,
+        "index2word": [voc.index2word[i] for i in range(voc.num_words)],
+        "timings": timings,
+    }
+    with open(os.path.join(directory, META_FILE), "w") as f:
+        json.dump(meta, f)
+    return timings
+
+
+'''SEARCH'''
+
+
+def topK(scores, k):
+    '''Returns (scores, columns) of the k best entries of each row, best first.'''
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((len(scores), 0), scores.dtype), np.empty((len(scores), 0), np.int64)
+    columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    best = np.take_along_axis(scores, columns, axis=1)
+    order = np.argsort(-best, axis=1, kind="stable")
+    return np.take_along_axis(best, order, axis=1), np.take_along_axis(columns, order, axis=1)
+
+
+class RetrievalIndex:
+    def __init__(self, directory, mmap=True):
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.index2word = self.meta["index2word"]
+        mode = "r" if mmap else None
+        self.vectors = np.load(os.path.join(directory, VECTORS_FILE), mmap_mode=mode)
+        self.response_ids = np.load(os.path.join(directory, "response_ids.npy"), mmap_mode=mode)
+        self.response_offsets = np.load(os.path.join(directory, "response_offsets.npy"))
+        self.response_lengths = np.load(os.path.join(directory, "response_lengths.npy"))
+        self.centroids = None
+        if self.meta["n_lists"]:
+            self.centroids = np.load(os.path.join(directory, "centroids.npy"))
+            self.list_rows = np.load(os.path.join(directory, "list_rows.npy"))
+            self.list_offsets = np.load(os.path.join(directory, "list_offsets.npy"))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def checkEncoder(self, encoder):
+        '''Raises ValueError unless `encoder` is the one the index was built with.'''
+        if encoder.hidden_size != self.meta["hidden_size"]:
+            raise ValueError("index {} holds {}-dim vectors but the encoder has hidden_size {}".format(
+                self.directory, self.meta["hidden_size"], encoder.hidden_size))
+        if encoderFingerprint(encoder) != self.meta.get("encoder_sha256"):
+            raise ValueError("index {} was not built with this encoder (built from {}); rebuild it".format(
+                self.directory, self.meta.get("checkpoint") or "an unrecorded checkpoint"))
+
+    def search(self, queries, k=5, nprobe=None, chunk_size=65536):
+        '''
+        Top-k cosine search for a (n_queries, hidden_size) batch of
+        normalized vectors. With nprobe, and partitions in the index,
+        only the nprobe closest partitions are scanned. Returns
+        (scores, rows), both (n_queries, k); missing results are -inf/-1.
+        '''
+        queries = np.asarray(queries, dtype=np.float32)
+        if nprobe and self.centroids is not None:
+            return self._searchPartitions(queries, k, nprobe)
+        best_scores = np.empty((len(queries), 0), np.float32)
+        best_rows = np.empty((len(queries), 0), np.int64)
+        for start in range(0, len(self.vectors), chunk_size):
+            scores = queries @ np.asarray(self.vectors[start:start + chunk_size]).T
+            scores, rows = topK(scores, k)
+            best_scores, columns = topK(np.concatenate([best_scores, scores], axis=1), k)
+            best_rows = np.take_along_axis(np.concatenate([best_rows, rows + start], axis=1), columns, axis=1)
+        return self._pad(best_scores, best_rows, k)
+
+    def _searchPartitions(self, queries, k, nprobe):
+        _, probes = topK(queries @ self.centroids.T, nprobe)
+        best_scores = np.full((len(queries), k), -np.inf, np.float32)
+        best_rows = np.full((len(queries), k), -1, np.int64)
+        # Group (query, partition) probes by partition, so each partition
+        # is scored against all the queries that probe it in one matmul
+        probe_queries = np.repeat(np.arange(len(queries)), probes.shape[1])
+        probe_lists = probes.ravel()
+        order = np.argsort(probe_lists, kind="stable")
+        probe_queries, probe_lists = probe_queries[order], probe_lists[order]
+        starts = np.flatnonzero(np.r_[True, probe_lists[1:] != probe_lists[:-1]])
+        for first, last in zip(starts, np.r_[starts[1:], len(probe_lists)]):
+            c = probe_lists[first]
+            # Rows of a partition are stored in ascending order
+            rows = self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]]
+            if len(rows) == 0:
+                continue
+            members = probe_queries[first:last]
+            scores, columns = topK(queries[members] @ np.asarray(self.vectors[rows]).T, k)
+            merged, picks = topK(np.concatenate([best_scores[members], scores], axis=1), k)
+            best_rows[members] = np.take_along_axis(
+                np.concatenate([best_rows[members], rows[columns]], axis=1), picks, axis=1)
+            best_scores[members] = merged
+        return best_scores, best_rows
+
+    @staticmethod
+    def _pad(scores, rows, k):
+        if scores.shape[1] == k:
+            return scores, rows
+        padding = k - scores.shape[1]
+        return (np.pad(scores, ((0, 0), (0, padding)), constant_values=-np.inf),
+                np.pad(rows, ((0, 0), (0, padding)), constant_values=-1))
+
+    def response(self, row):
+        '''Stored response words for an index row.'''
+        start = self.response_offsets[row]
+        ids = self.response_ids[start:start + self.response_lengths[row]]
+        return [self.index2word[int(i)] for i in ids]
+
+    @property
+    def nbytes(self):
+        arrays = [self.vectors, self.response_ids, self.response_offsets, self.response_lengths]
+        if self.centroids is not None:
+            arrays += [self.centroids, self.list_rows, self.list_offsets]
+        return sum(a.nbytes for a in arrays)
+
+
+'''RESPOND'''
+
+
+class RetrievalResponder:
+    '''
+    Answers a batch of sentences from the index, falling back to greedy
+    generation for inputs whose best match scores below threshold.
+    '''
+    def __init__(self, index, encoder, decoder, voc, threshold=0.9, nprobe=None, max_length=MAX_LENGTH):
+        self.index = index
+        self.encoder = encoder
+        self.searcher = GreedySearchDecoder(encoder, decoder)
+        self.voc = voc
+        self.threshold = threshold
+        self.nprobe = nprobe
+        self.max_length = max_length
+
+    def respond(self, sentences):
+        '''
+        Takes normalized sentences and returns one (words, source, score)
+        per sentence, where source is 'retrieval', 'generation' or
+        'unknown' (a word missing from voc).
+        '''
+        results = [(None, "unknown", None)] * len(sentences)
+        known = []
+        for i, sentence in enumerate(sentences):
+            try:
+                indexesFromSentence(self.voc, sentence)
+                known.append(i)
+            except KeyError:
+                pass
+        if not known:
+            return results
+        vectors = encodeSentences(self.encoder, self.voc, [sentences[i] for i in known])
+        scores, rows = self.index.search(vectors, k=1, nprobe=self.nprobe)
+        fallback = []
+        for i, score, row in zip(known, scores[:, 0], rows[:, 0]):
+            if row >= 0 and score >= self.threshold:
+                results[i] = (self.index.response(row), "retrieval", float(score))
+            else:
+                fallback.append((i, float(score)))
+        if fallback:
+            generated = generateBatch(self.searcher, self.voc, [sentences[i] for i, _ in fallback],
+                                      self.max_length)
+            for (i, score), words in zip(fallback, generated):
+                results[i] = (words, "generation", score)
+        return results
+
+
+def chatInput(responder):
+    '''evaluateInput, answering from the index where possible.'''
+    while True:
+        input_sentence = input('> ')
+        if input_sentence == 'q' or input_sentence == 'quit':
+            break
+        words, source, score = responder.respond([normalizeString(input_sentence)])[0]
+        if words is None:
+            print("Error: Encountered unknown word.")
+            continue
+        print('Bot:', ' '.join(words), '({} {:.3f})'.format(source, score))
+
+
+'''COMMAND LINE'''
+
+
+def addModelArgs(parser):
+    parser.add_argument("checkpoint", help="trainIters checkpoint (.tar)")
+    parser.add_argument("--attn-model", default=DEFAULT_CONFIG["attn_model"])
+    parser.add_argument("--hidden-size", type=int, default=DEFAULT_CONFIG["hidden_size"])
+    parser.add_argument("--encoder-n-layers", type=int, default=DEFAULT_CONFIG["encoder_n_layers"])
+    parser.add_argument("--decoder-n-layers", type=int, default=DEFAULT_CONFIG["decoder_n_layers"])
+
+
+def loadModelFromArgs(args):
+    return loadModel(args.checkpoint, args.attn_model, args.hidden_size,
+                     args.encoder_n_layers, args.decoder_n_layers)
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    build = commands.add_parser("build", help="Encode the training queries into an index")
+    addModelArgs(build)
+    build.add_argument("--out", required=True, help="Index directory")
+    build.add_argument("--datafile", default=datafile)
+    build.add_argument("--valid-fraction", type=float, default=0.05,
+                       help="Must match training so held-out pairs stay out of the index")
+    build.add_argument("--batch-size", type=int, default=1024)
+    build.add_argument("--n-lists", type=int, default=0, help="k-means partitions for IVF search (0: exact only)")
+
+    chat = commands.add_parser("chat", help="Chat, answering from the index where possible")
+    chat.add_argument("index", help="Index directory")
+    addModelArgs(chat)
+    chat.add_argument("--threshold", type=float, default=0.9)
+    chat.add_argument("--nprobe", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    # Serving settings saved by `python autotune.py` for this host, if any
+    applyHostProfile("serve")
+    voc, embedding, encoder, decoder = loadModelFromArgs(args)
+    if args.command == "build":
+        _, pairs = loadTrimmedArrays(args.datafile, voc)
+        pairs, _ = splitPairs(pairs, args.valid_fraction)
+        timings = buildIndex(encoder, voc, pairs, args.out, args.batch_size, args.n_lists,
+                             checkpoint=os.path.abspath(args.checkpoint))
+        print("Indexed {} queries in {}: {}".format(len(pairs), args.out, timings))
+    else:
+        index = RetrievalIndex(args.index)
+        index.checkEncoder(encoder)
+        responder = RetrievalResponder(index, encoder, decoder, voc, args.threshold, args.nprobe)
+        chatInput(responder)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
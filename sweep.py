@@ -0,0 +1,267 @@
+'''
+Hyperparameter sweep runner.
+
+Prepares `voc` and the trimmed pairs once, moves the PairArrays into
+shared memory and runs one trainIters job per configuration in a pool
+of worker processes, each limited to its own number of torch threads.
+The final loss and throughput of every job are collected into one
+results table.
+
+The spec is a JSON file:
+
+    {
+        "mode": "random",
+        "samples": 8,
+        "seed": 0,
+        "params": {
+            "hidden_size": [256, 500],
+            "attn_model": ["dot", "concat"],
+            "learning_rate": {"min": 1e-5, "max": 1e-3, "log": true}
+        },
+        "fixed": {"n_iteration": 500}
+    }
+
+"mode" is "grid" (every combination of the listed values) or "random"
+("samples" draws, seeded by "seed"). {"min", "max", "log"} ranges are
+only valid in random mode. Any key of DEFAULT_CONFIG can appear in
+"params" or "fixed".
+
+    python sweep.py spec.json --jobs 4 --output sweep_results
+'''
+
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch import optim
+
+from chatbot import (
+    DEFAULT_CONFIG, Voc, PairArrays, buildModel,
+    corpus, corpus_name, datafile, writeFormattedFile, loadTrimmedArrays, trainIters,
+)
+from hostprofile import applySettings
+from instrumentation import TrainingInstrumentation
+
+
+RESULT_FIELDS = ["job", "final_loss", "tokens_per_sec", "seconds_per_iteration", "seconds", "error"]
+
+
+'''SEARCH SPACE'''
+
+
+def gridConfigs(params):
+    '''Every combination of the listed parameter values.'''
+    names = sorted(params)
+    for name in names:
+        if not isinstance(params[name], list):
+            raise ValueError("grid mode needs a list of values for {!r}".format(name))
+    for values in itertools.product(*(params[name] for name in names)):
+        yield dict(zip(names, values))
+
+
+def sampleValue(spec, rng):
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    low, high = spec["min"], spec["max"]
+    if spec.get("log"):
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    if isinstance(low, int) and isinstance(high, int):
+        return rng.randint(low, high)
+    return rng.uniform(low, high)
+
+
+def randomConfigs(params, samples, seed):
+    '''`samples` configurations drawn independently per parameter.'''
+    rng = random.Random(seed)
+    for _ in range(samples):
+        yield {name: sampleValue(params[name], rng) for name in sorted(params)}
+
+
+def expandSpec(spec):
+    '''Returns the list of full job configurations described by spec.'''
+    params = spec.get("params", {})
+    fixed = spec.get("fixed", {})
+    unknown = (set(params) | set(fixed)) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError("unknown sweep parameters: {}".format(", ".join(sorted(unknown))))
+    mode = spec.get("mode", "grid")
+    if mode == "grid":
+        configs = gridConfigs(params)
+    elif mode == "random":
+        configs = randomConfigs(params, spec.get("samples", 8), spec.get("seed", 0))
+    else:
+        raise ValueError(mode, "is not an appropriate sweep mode.")
+    jobs = []
+    for config in configs:
+        full = dict(DEFAULT_CONFIG)
+        full.update(fixed)
+        full.update(config)
+        jobs.append(full)
+    return jobs
+
+
+'''SHARED DATASET'''
+
+
+# torch has no uint16/uint32 tensors, so those are widened before sharing
+TORCH_DTYPES = {np.dtype(np.uint16): np.int32, np.dtype(np.uint32): np.int64}
+
+
+def shareArrays(arrays):
+    '''
+    Copies the PairArrays fields into shared-memory tensors. Passed to
+    worker processes, they are mapped rather than pickled and copied.
+    '''
+    tensors = []
+    for array in (arrays.ids, arrays.query_offsets, arrays.query_lengths,
+                  arrays.response_lengths):
+        array = array.astype(TORCH_DTYPES.get(array.dtype, array.dtype), copy=False)
+        tensors.append(torch.from_numpy(array).share_memory_())
+    return tensors
+
+
+# Per-worker state, set once by initWorker
+_worker = {}
+
+
+def initWorker(voc_dict, tensors, threads):
+    applySettings({"threads": threads, "interop_threads": 1})
+    voc = Voc(voc_dict["name"])
+    voc.__dict__ = voc_dict
+    _worker["voc"] = voc
+    # Zero-copy NumPy views onto the shared tensors; keep the tensors alive with them
+    _worker["tensors"] = tensors
+    _worker["pairs"] = PairArrays(*(tensor.numpy() for tensor in tensors))
+
+
+'''JOBS'''
+
+
+def runJob(job):
+    '''Trains one configuration in a worker and returns its result row.'''
+    index, config, output_dir = job
+    result = {"job": index, "config": config, "error": None}
+    try:
+        voc, pairs = _worker["voc"], _worker["pairs"]
+        random.seed(config["seed"])
+        torch.manual_seed(config["seed"])
+
+        embedding, encoder, decoder = buildModel(voc.num_words, config)
+        encoder.train()
+        decoder.train()
+        encoder_optimizer = optim.Adam(encoder.parameters(), lr=config["learning_rate"])
+        decoder_optimizer = optim.Adam(decoder.parameters(),
+                                       lr=config["learning_rate"] * config["decoder_learning_ratio"])
+
+        n_iteration = config["n_iteration"]
+        # The final loss is the average over the last tenth of the run
+        instrumentation = TrainingInstrumentation(
+            os.path.join(output_dir, "job-{}.jsonl".format(index)),
+            interval=max(1, n_iteration // 10))
+        start = time.perf_counter()
+        trainIters("sweep-{}".format(index), voc, pairs, encoder, decoder, encoder_optimizer,
+                   decoder_optimizer, embedding, config["encoder_n_layers"],
+                   config["decoder_n_layers"], output_dir, n_iteration, config["batch_size"],
+                   n_iteration, n_iteration + 1, config["clip"], corpus_name, None,
+                   teacher_forcing_ratio=config["teacher_forcing_ratio"],
+                   instrumentation=instrumentation)
+        instrumentation.close()
+        summary = instrumentation.summary()
+        result.update({
+            "final_loss": instrumentation.last_record["loss"],
+            "tokens_per_sec": summary["tokens_per_sec"],
+            "seconds_per_iteration": summary["seconds"] / summary["iterations"],
+            "seconds": time.perf_counter() - start,
+        })
+    except Exception as e:
+        result["error"] = repr(e)
+    return result
+
+
+def printTable(results, param_names):
+    header = RESULT_FIELDS[:-1] + param_names
+    rows = []
+    for result in results:
+        row = [result.get(field) for field in RESULT_FIELDS[:-1]]
+        row += [result["config"][name] for name in param_names]
+        rows.append(["{:.4g}".format(v) if isinstance(v, float) else str(v) for v in row])
+    widths = [max(len(h), *(len(r[i]) for r in rows)) if rows else len(h) for i, h in enumerate(header)]
+    print("  ".join(h.ljust(w) for h, w in zip(header, widths)))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+    for result in results:
+        if result["error"]:
+            print("job {} failed: {}".format(result["job"], result["error"]))
+
+
+def writeResults(results, output_dir):
+    names = sorted(DEFAULT_CONFIG)
+    with open(os.path.join(output_dir, "results.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(RESULT_FIELDS + names)
+        for result in results:
+            writer.writerow([result.get(field) for field in RESULT_FIELDS]
+                            + [result["config"][name] for name in names])
+    with open(os.path.join(output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("spec", help="JSON sweep spec")
+    parser.add_argument("--datafile", default=datafile,
+                        help="Formatted query/response file (written from the corpus if missing)")
+    parser.add_argument("--jobs", type=int, default=2, help="Number of parallel worker processes")
+    parser.add_argument("--threads-per-job", type=int, default=None,
+                        help="torch threads per worker (default: CPUs / jobs)")
+    parser.add_argument("--output", default=os.path.join("data", "sweep"))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    with open(args.spec) as f:
+        spec = json.load(f)
+    configs = expandSpec(spec)
+    print("Sweeping {} configurations with {} workers".format(len(configs), args.jobs))
+    threads = args.threads_per_job or max(1, (os.cpu_count() or 1) // args.jobs)
+    os.makedirs(args.output, exist_ok=True)
+
+    # Preprocess once for every job
+    if not os.path.exists(args.datafile):
+        writeFormattedFile(corpus, args.datafile)
+    voc, pairs = loadTrimmedArrays(args.datafile)
+    tensors = shareArrays(pairs)
+    del pairs
+
+    jobs = [(i, config, args.output) for i, config in enumerate(configs)]
+    results = []
+    context = mp.get_context("spawn")
+    with context.Pool(args.jobs, initializer=initWorker,
+                      initargs=(voc.__dict__, tensors, threads)) as pool:
+        for result in pool.imap_unordered(runJob, jobs):
+            status = result["error"] or "loss {:.4f}".format(result["final_loss"])
+            print("job {} done: {}".format(result["job"], status))
+            results.append(result)
+
+    results.sort(key=lambda r: (r["error"] is not None, r.get("final_loss") or 0.0))
+    varied = sorted(spec.get("params", {}))
+    print()
+    printTable(results, varied)
+    writeResults(results, args.output)
+    print("Wrote results to", args.output)
+    return 0 if all(r["error"] is None for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())